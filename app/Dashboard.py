@@ -1,12 +1,8 @@
 import os
-import hashlib
-import requests
 import datetime
 import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, firestore, auth
-from dotenv import load_dotenv
-from utils import show_footer, custom_css
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from utils import show_footer, custom_css, get_db, get_http, fetch_doctor, fetch_settings, migrate_legacy_settings, HTTP_TIMEOUT, DEFAULT_SETTINGS
 
 # Configure Streamlit page settings
 st.set_page_config(
@@ -16,17 +12,77 @@ st.set_page_config(
     # initial_sidebar_state="collapsed"
 )
 
-# Load environment variables from .env file
-load_dotenv()
+custom_css()
+
+# Quick Access buttons and the pages they open
+NAV_PAGES = (
+    ("📋 Treatment", "pages/1_Treatment.py"),
+    ("📦 Inventory", "pages/2_Inventory.py"),
+    ("📅 Schedule", "pages/3_Schedule.py"),
+    ("📞 Contact", "pages/4_Contact.py"),
+    ("⚙️ Settings", "pages/5_Settings.py")
+)
 
-# Initialize Firebase
-if not firebase_admin._apps:
-    cred = credentials.Certificate("firebase-config.json")
-    firebase_admin.initialize_app(cred)
+# Signed login tokens kept in the URL survive a page reload for up to 14 days
+SESSION_TOKEN_PARAM = "t"
+SESSION_MAX_AGE = 14 * 24 * 60 * 60
 
-database = firestore.client()
+# Session flags for the account settings forms; at most one is shown at a time
+ACCOUNT_FORM_FLAGS = ("show_reset_password", "show_reset_email", "show_delete_account")
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def current_datetime():
+    """Return the formatted date and time for the welcome banner, refreshed at most every 30 seconds"""
+    now = datetime.datetime.now()
+    return now.strftime("%A, %B %d, %Y"), now.strftime("%I:%M %p")
+
+
+def session_serializer():
+    """Return the login token serializer, or None when no SESSION_SECRET is configured"""
+    secret = os.getenv("SESSION_SECRET")
+    return URLSafeTimedSerializer(secret, salt="doctor-login") if secret else None
+
+
+def remember_login(email):
+    """Store a signed login token for this doctor in the page URL"""
+    serializer = session_serializer()
+    if serializer:
+        st.query_params[SESSION_TOKEN_PARAM] = serializer.dumps({"email": email})
+
+
+def restore_login():
+    """Log the doctor back in from a valid URL token, using the cached profile lookup"""
+    token = st.query_params.get(SESSION_TOKEN_PARAM)
+    serializer = session_serializer()
+    if not token or serializer is None:
+        return
+
+    try:
+        email = serializer.loads(token, max_age=SESSION_MAX_AGE)["email"]
+    except (BadSignature, KeyError, TypeError):
+        # Expired or tampered token - drop it and fall back to the login form
+        del st.query_params[SESSION_TOKEN_PARAM]
+        return
+
+    doctor_data = fetch_doctor(email)
+    if doctor_data:
+        st.session_state["logged_in"] = True
+        st.session_state["doctor_name"] = doctor_data.get("name", "")
+        st.session_state["doctor_email"] = email
+
+
+def logout():
+    """Forget the signed-in doctor; used as a button callback"""
+    st.session_state.clear()  # Clear session state on logout
+    st.query_params.clear()  # Forget the login token
+
+
+def show_account_form(form_flag):
+    """Show one account settings form and hide the others; used as a button callback"""
+    for flag in ACCOUNT_FORM_FLAGS:
+        st.session_state[flag] = flag == form_flag
 
-custom_css()
 
 def main():
     st.image('assets/header.jpg', use_container_width=True)
@@ -35,75 +91,14 @@ def main():
     # Initialize session state for login tracking
     if "logged_in" not in st.session_state:
         st.session_state["logged_in"] = False
+        restore_login()
 
     # UI flow tracking
-    if "show_reset_password" not in st.session_state:
-        st.session_state["show_reset_password"] = False
-    if "show_reset_email" not in st.session_state:
-        st.session_state["show_reset_email"] = False
-    if "show_delete_account" not in st.session_state:
-        st.session_state["show_delete_account"] = False
-
-    if st.session_state["logged_in"]:
-        # Logged-in user view
-        current_date = datetime.datetime.now()
-        date_str = current_date.strftime("%A, %B %d, %Y")
-        time_str = current_date.strftime("%H:%M %p")
-
-        st.subheader(f"Welcome, Dr. {st.session_state['doctor_name']}!")
-        st.caption(f"{date_str} | {time_str}")
-
-        show_nav()
-
-        # Logout, Reset Password, and Delete Account buttons
-        st.divider()
-        st.markdown("### Account Settings")
-        col1, col2, col3, col4 = st.columns(4)
-
-        with col1:
-            if st.button("Logout", icon="↩️", use_container_width=True):
-                st.session_state.clear()  # Clear session state on logout
-                st.rerun()  # Refresh the app
-
-        with col2:
-            if st.button("Reset Password", icon="🔄", use_container_width=True):
-                st.session_state["show_reset_password"] = True
-                st.session_state["show_reset_email"] = False
-                st.session_state["show_delete_account"] = False
-                st.rerun()  # Force a rerun to show the reset password form
-
-        with col3:
-            if st.button("Change Email", icon="📧", use_container_width=True):
-                st.session_state["show_reset_email"] = True
-                st.session_state["show_reset_password"] = False
-                st.session_state["show_delete_account"] = False
-                st.rerun()  # Force a rerun to show the reset email form
-
-        with col4:
-            if st.button("Delete Account", icon="🗑️", use_container_width=True):
-                st.session_state["show_delete_account"] = True
-                st.session_state["show_reset_password"] = False
-                st.session_state["show_reset_email"] = False
-                st.rerun()  # Force a rerun to show the delete account form
-
-        # Show appropriate form based on user selection
-        if st.session_state["show_reset_password"]:
-            with st.container():
-                st.divider()
-                reset_password()
-
-        if st.session_state["show_reset_email"]:
-            with st.container():
-                st.divider()
-                reset_email()
-
-        if st.session_state["show_delete_account"]:
-            with st.container():
-                st.divider()
-                delete_account()
+    for flag in ACCOUNT_FORM_FLAGS:
+        st.session_state.setdefault(flag, False)
 
-    else:
-        # Non-logged in user view
+    if not st.session_state["logged_in"]:
+        # Non-logged in user view - return before any of the dashboard widgets are built
         # Create two columns for description and login
         desc_col, auth_col = st.columns([1, 1])
 
@@ -114,9 +109,7 @@ def main():
             # Check if we should show reset password form instead of login/signup
             if st.session_state["show_reset_password"]:
                 reset_password()
-                if st.button("Back to Login", use_container_width=True):
-                    st.session_state["show_reset_password"] = False
-                    st.rerun()
+                st.button("Back to Login", use_container_width=True, on_click=show_account_form, args=(None,))
             else:
                 tab1, tab2 = st.tabs(["Sign In", "Sign Up"])
 
@@ -125,6 +118,52 @@ def main():
 
                 with tab2:
                     sign_up()
+        return
+
+    # Logged-in user view
+    date_str, time_str = current_datetime()
+
+    st.subheader(f"Welcome, Dr. {st.session_state['doctor_name']}!")
+    st.caption(f"{date_str} | {time_str}")
+
+    show_nav()
+
+    # Logout, Reset Password, and Delete Account buttons
+    st.divider()
+    st.markdown("### Account Settings")
+    col1, col2, col3, col4 = st.columns(4)
+
+    # Callbacks run before the next script run, so no extra st.rerun() is needed
+    with col1:
+        st.button("Logout", icon="↩️", use_container_width=True, on_click=logout)
+
+    with col2:
+        st.button("Reset Password", icon="🔄", use_container_width=True,
+                  on_click=show_account_form, args=("show_reset_password",))
+
+    with col3:
+        st.button("Change Email", icon="📧", use_container_width=True,
+                  on_click=show_account_form, args=("show_reset_email",))
+
+    with col4:
+        st.button("Delete Account", icon="🗑️", use_container_width=True,
+                  on_click=show_account_form, args=("show_delete_account",))
+
+    # Show appropriate form based on user selection
+    if st.session_state["show_reset_password"]:
+        with st.container():
+            st.divider()
+            reset_password()
+
+    if st.session_state["show_reset_email"]:
+        with st.container():
+            st.divider()
+            reset_email()
+
+    if st.session_state["show_delete_account"]:
+        with st.container():
+            st.divider()
+            delete_account()
 
 
 def show_info():
@@ -148,62 +187,74 @@ def show_info():
     """, unsafe_allow_html=True)
 
 
+@st.fragment
 def show_nav():
+    """Render the Quick Access buttons; as a fragment, clicks rerun only this block"""
     st.markdown("### Quick Access")
-    col1, col2, col3, col4, col5 = st.columns(5)
 
-    with col1:
-        if st.button("📋 Treatment", use_container_width=True):
-            st.switch_page("pages/1_Treatment.py")
+    for col, (label, page) in zip(st.columns(len(NAV_PAGES)), NAV_PAGES):
+        with col:
+            if st.button(label, use_container_width=True):
+                st.switch_page(page)
 
-    with col2:
-        if st.button("📦 Inventory", use_container_width=True):
-            st.switch_page("pages/2_Inventory.py")
+    st.info("First-time user? Configure your settings to get started")
 
-    with col3:
-        if st.button("📅 Schedule", use_container_width=True):
-            st.switch_page("pages/3_Schedule.py")
 
-    with col4:
-        if st.button("📞 Contact", use_container_width=True):
-            st.switch_page("pages/4_Contact.py")
+def verify_credentials(email, password):
+    """Verify an email/password pair with Firebase Authentication, returning (success, error_message)"""
+    api_key = os.getenv("FIREBASE_API_KEY")
+    url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={api_key}"
+    payload = {
+        "email": email,
+        "password": password,
+        "returnSecureToken": True
+    }
 
-    with col5:
-        if st.button("⚙️ Settings", use_container_width=True):
-            st.switch_page("pages/5_Settings.py")
+    response = get_http().post(url, json=payload, timeout=HTTP_TIMEOUT)
+    if response.status_code == 200:
+        return True, None
 
-    st.info("First-time user? Configure your settings to get started")
+    error_data = response.json()
+    return False, error_data.get("error", {}).get("message", "Unknown error")
 
 
 def sign_up():
     st.subheader("Create a New Account")
     name = st.text_input("Name", key="signup_name")
-    email = st.text_input("Email", key="signup_email")
+    email = st.text_input("Email", key="signup_email").strip().lower()  # Normalized once so the document ID is stable
     password = st.text_input("Password", type="password", key="signup_password")
 
     if st.button("Sign Up", icon="🔒", use_container_width=True):
+        from firebase_admin import auth  # Deferred so the logged-out view never loads the Admin SDK
+
         try:
-            # Create user in Firebase Authentication
+            doctor_reference = get_db().collection("doctors").document(email)
+
+            # Create user in Firebase Authentication (must succeed before the profile is written)
             user = auth.create_user(email=email, password=password)
 
             # Store user details in Firestore
-            database.collection("doctors").document(email).set({
+            doctor_reference.set({
                 "name": name,
                 "email": email,
                 "uid": user.uid,
-                "password_hash": hashlib.sha256(password.encode()).hexdigest()
+                "settings": DEFAULT_SETTINGS
             })
+            fetch_doctor.clear(email)  # Drop any cached "user not found" result for this email
 
             st.success("Account created successfully! You can now sign in.")
-        except firebase_admin.auth.EmailAlreadyExistsError:
+        except auth.EmailAlreadyExistsError:
             st.warning("Email already in use. Please choose a different email.")
         except Exception as e:
             st.error(f"Error: {e}")
 
 
+@st.fragment
 def sign_in():
+    """Render the sign-in form; as a fragment, failed attempts rerun only the form"""
     st.subheader("Sign In to Your Account")
-    email = st.text_input("Email", key="signin_email")
+    raw_email = st.text_input("Email", key="signin_email").strip()
+    email = raw_email.lower()
     password = st.text_input("Password", type="password", key="signin_password")
 
     col1, col2 = st.columns(2)  # Split into two columns
@@ -214,34 +265,47 @@ def sign_in():
                 st.error("Please enter both email and password.")
             else:
                 try:
-                    # Check if user exists in Firestore
-                    doctor_doc = database.collection("doctors").document(email).get()
-                    if doctor_doc.exists:
-                        doctor_data = doctor_doc.to_dict()
-                        stored_hash = doctor_data.get("password_hash", "")
-
-                        # Check if entered password matches stored hash
-                        entered_hash = hashlib.sha256(password.encode()).hexdigest()
-                        if entered_hash == stored_hash:
-                            doctor_name = doctor_data.get("name", "")
-
-                            st.success(f"Welcome, Dr. {doctor_name}!")
-                            st.session_state["logged_in"] = True
-                            st.session_state["doctor_name"] = doctor_name
-                            st.session_state["doctor_email"] = email
-
-                            st.rerun()
-                        else:
-                            st.error("Invalid email or password.")
-                    else:
+                    # Firebase Authentication is the single source of truth for passwords
+                    authenticated, error_message = verify_credentials(email, password)
+                    doctor_data = fetch_doctor(email) if authenticated else None
+
+                    # Accounts created before emails were normalized keep their mixed-case document ID (moving it
+                    # would orphan the stock/patient subcollections), so fall back to the address as typed
+                    if authenticated and not doctor_data and raw_email != email:
+                        email = raw_email
+                        doctor_data = fetch_doctor(email)
+
+                    if doctor_data:
+                        doctor_name = doctor_data.get("name", "")
+
+                        st.success(f"Welcome, Dr. {doctor_name}!")
+                        st.session_state["logged_in"] = True
+                        st.session_state["doctor_name"] = doctor_name
+                        st.session_state["doctor_email"] = email
+                        remember_login(email)
+
+                        # Older accounts still keep their settings in a subcollection; move them onto the profile once
+                        if "settings" not in doctor_data:
+                            migrate_legacy_settings(email)
+
+                        # Purge the password hash older accounts still carry; Firebase Auth owns passwords now
+                        if "password_hash" in doctor_data:
+                            from firebase_admin import firestore
+                            get_db().collection("doctors").document(email).update({"password_hash": firestore.DELETE_FIELD})
+                            fetch_doctor.clear(email)
+
+                        st.rerun(scope="app")  # Leave the fragment and redraw the dashboard
+                    elif authenticated or error_message == "EMAIL_NOT_FOUND":
                         st.error("User not found. Please check your email or create an account.")
+                    else:
+                        st.error("Invalid email or password.")
                 except Exception as e:
                     st.error(f"Error: {e}")
 
     with col2:
         if st.button("Forgot Password?", use_container_width=True):
             st.session_state["show_reset_password"] = True
-            st.rerun()
+            st.rerun(scope="app")  # The reset form replaces the tabs outside this fragment
 
 
 def reset_password():
@@ -265,7 +329,7 @@ def reset_password():
 
             with st.spinner("Processing request..."):
                 try:
-                    response = requests.post(url, json=payload)
+                    response = get_http().post(url, json=payload, timeout=HTTP_TIMEOUT)
 
                     if response.status_code == 200:
                         st.success("✅ Password reset email sent!")
@@ -294,7 +358,7 @@ def reset_email():
     current_email = st.session_state.get("doctor_email")
     st.info(f"Current email: {current_email}")
 
-    new_email = st.text_input("New Email Address", key="new_email_input")
+    new_email = st.text_input("New Email Address", key="new_email_input").strip().lower()  # Same normalization as sign-in
     password = st.text_input("Confirm your password", type="password", key="confirm_password_email_change")
 
     col1, col2 = st.columns([1, 1])
@@ -309,17 +373,19 @@ def reset_email():
                 st.error("Please confirm your password.")
                 return
 
+            from firebase_admin import auth
+
             # First verify the password
             try:
+                authenticated, _ = verify_credentials(current_email, password)
+                if not authenticated:
+                    st.error("Incorrect password. Email change canceled.")
+                    return
+
+                database = get_db()
                 doctor_doc = database.collection("doctors").document(current_email).get()
                 if doctor_doc.exists:
                     doctor_data = doctor_doc.to_dict()
-                    stored_hash = doctor_data.get("password_hash", "")
-                    entered_hash = hashlib.sha256(password.encode()).hexdigest()
-
-                    if entered_hash != stored_hash:
-                        st.error("Incorrect password. Email change canceled.")
-                        return
                 else:
                     st.error("User data not found. Please try logging in again.")
                     return
@@ -333,13 +399,20 @@ def reset_email():
                         auth.update_user(user.uid, email=new_email)
                         # Update Firestore document
                         doctor_data["email"] = new_email
+                        # Don't carry a legacy password hash over to the new document
+                        doctor_data.pop("password_hash", None)
 
                         # Update Firestore document with new email and delete old one
                         database.collection("doctors").document(new_email).set(doctor_data)
                         database.collection("doctors").document(current_email).delete()
+                        # Only the two addresses involved change; other doctors keep their cached profiles
+                        for changed_email in (current_email, new_email):
+                            fetch_doctor.clear(changed_email)
+                            fetch_settings.clear(changed_email)
 
                         # Update session state
                         st.session_state["doctor_email"] = new_email
+                        remember_login(new_email)
                         st.success("✅ Email address updated successfully!")
                         st.info(f"Your account is now associated with {new_email}")
 
@@ -347,7 +420,7 @@ def reset_email():
                         st.session_state["show_reset_email"] = False
                         st.rerun()
 
-                    except firebase_admin.auth.EmailAlreadyExistsError:
+                    except auth.EmailAlreadyExistsError:
                         st.error("This email is already associated with another account.")
                     except Exception as e:
                         st.error(f"Failed to update email: {str(e)}")
@@ -372,27 +445,31 @@ def delete_account():
 
     with col1:
         if st.button("Permanently Delete My Account", use_container_width=True):
+            from firebase_admin import auth
+
             try:
                 # Confirm password before deletion
-                doc = database.collection("doctors").document(email).get()
-                stored_hash = doc.to_dict().get("password_hash", "")
-                entered_hash = hashlib.sha256(password.encode()).hexdigest()
-
-                if entered_hash != stored_hash:
+                authenticated, _ = verify_credentials(email, password)
+                if not authenticated:
                     st.error("Incorrect password.")
                     return
 
+                database = get_db()
+
                 # Delete from both Firestore and Firebase Auth
                 user = auth.get_user_by_email(email)
                 database.collection("doctors").document(email).delete()
                 auth.delete_user(user.uid)
+                fetch_doctor.clear(email)
+                fetch_settings.clear(email)
 
                 # Clear session state and show success message
                 st.success("Account deleted successfully.")
                 st.session_state.clear()
+                st.query_params.clear()
                 st.rerun()
 
-            except firebase_admin.auth.UserNotFoundError:
+            except auth.UserNotFoundError:
                 st.error("User not found in authentication.")
             except Exception as e:
                 st.error(f"Error during deletion: {str(e)}")
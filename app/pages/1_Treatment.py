@@ -1,11 +1,16 @@
-import json
+import io
+import os
+import re
+import copy
 import streamlit as st
 import pandas as pd
 from datetime import datetime, timedelta
-from firebase_admin import firestore
-from cloudinary.uploader import upload, destroy
+from cloudinary.uploader import upload, upload_large, destroy
 from cloudinary.utils import cloudinary_url
-from utils import format_date, show_footer, generate_pdf, render_chart, get_currency_symbol, configure_cloudinary
+from PIL import Image, ImageOps
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+from utils import show_footer, generate_pdf, render_chart, get_currency_symbol, configure_cloudinary, get_db, fetch_doctor, fetch_settings, DEFAULT_SETTINGS, load_dental_data
 
 # Initialize session state variables to track patient status and treatment records
 if "patient_status" not in st.session_state:
@@ -14,23 +19,44 @@ if "patient_status" not in st.session_state:
 if "treatment_record" not in st.session_state:
     st.session_state.treatment_record = []
 
-database = firestore.client()
+database = get_db()
+
+# X-rays larger than this are sent to Cloudinary in chunks of this size instead of one request
+XRAY_CHUNK_SIZE = 6 * 1024 * 1024
+
+# X-rays larger than this are downscaled and re-encoded as JPEG before upload
+XRAY_COMPRESS_SIZE = 2_000_000
+XRAY_MAX_DIMENSION = 2400
+
+# Anything other than letters, digits, dots and dashes is collapsed to "_" in report file names
+UNSAFE_FILENAME_CHARS = re.compile(r"[^\w.-]+")
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_patient_cached(doctor_email, file_id):
+    """Fetch a single patient document, cached briefly; every helper that writes a patient clears its entry"""
+    doctor_reference = database.collection("doctors").document(doctor_email)
+    patient_document = doctor_reference.collection("patients").document(file_id).get()
+    return patient_document.to_dict() if patient_document.exists else None
+
+
+def remember_patient(file_id, fields):
+    """Mirror saved fields onto the active patient in session state so later reruns don't need to re-read them"""
+    patient_selected = st.session_state.get("patient_selected")
+    if st.session_state.patient_status and patient_selected and patient_selected.get("file_id") == file_id:
+        patient_selected.update(fields)
 
 
 def fetch_patient(doctor_email, identifier, search_by="id"):
     """Fetch patient information from Firestore based on ID or name."""
     try:
-        doctor_reference = database.collection("doctors").document(doctor_email)
-
         # ID-based search (exact match)
         if search_by == "id":
-            patient_document = doctor_reference.collection("patients").document(identifier).get()
-            if patient_document.exists:
-                return patient_document.to_dict()
-            return None
+            return _fetch_patient_cached(doctor_email, identifier)
 
         # Name-based search (case-insensitive partial match)
         elif search_by == "name":
+            doctor_reference = database.collection("doctors").document(doctor_email)
             patients_collection = doctor_reference.collection("patients")
             patients = patients_collection.get()
 
@@ -52,8 +78,13 @@ def store_patient(doctor_email, patient_info):
     """Store new patient information in Firestore under the doctor's collection"""
     try:
         doctor_reference = database.collection("doctors").document(doctor_email)
-        doctor_reference.collection("patients").document(patient_info["file_id"]).set(patient_info)
+        # create() fails if the file ID is already taken, so duplicates are rejected without reading first
+        doctor_reference.collection("patients").document(patient_info["file_id"]).create(patient_info)
+        _fetch_patient_cached.clear(doctor_email, patient_info["file_id"])  # Drop a cached "not found" for this ID
         return True
+    except AlreadyExists:
+        st.error(f"Registration Error: File ID {patient_info['file_id']} already exists in the database")
+        return False
     except Exception as e:
         st.error(f"Database Error: Failed to store patient - {str(e)}")
         return False
@@ -65,6 +96,8 @@ def modify_patient(doctor_email, file_id, patient_data):
         doctor_reference = database.collection("doctors").document(doctor_email)
         patient_document = doctor_reference.collection("patients").document(file_id)
         patient_document.update(patient_data)
+        _fetch_patient_cached.clear(doctor_email, file_id)
+        remember_patient(file_id, patient_data)
         return True
     except Exception as e:
         st.error(f"Database Error: Failed to modify patient - {str(e)}")
@@ -77,28 +110,315 @@ def modify_treatment(doctor_email, file_id, treatment_record):
         doctor_reference = database.collection("doctors").document(doctor_email)
         patient_document = doctor_reference.collection("patients").document(file_id)
         patient_document.update({"treatment_plan": treatment_record})
+        _fetch_patient_cached.clear(doctor_email, file_id)
+        remember_patient(file_id, {"treatment_plan": treatment_record})
         return True
     except Exception as e:
         st.error(f"Database Error: Failed to modify treatment - {str(e)}")
         return False
 
 
-def load_settings(doctor_email):
-    """Load doctor settings from Firestore including treatment procedures, health conditions, and prices"""
+def commit_patient_changes(doctor_email, file_id, updates):
+    """Write every changed patient field collected during a run in a single Firestore update"""
+    try:
+        doctor_reference = database.collection("doctors").document(doctor_email)
+        patient_document = doctor_reference.collection("patients").document(file_id)
+        patient_document.update(updates)
+        _fetch_patient_cached.clear(doctor_email, file_id)
+        remember_patient(file_id, updates)
+        return True
+    except Exception as e:
+        st.error(f"Database Error: Failed to save patient changes - {str(e)}")
+        return False
+
+
+def compress_xray(image_file):
+    """Downscale and re-encode large JPEG X-ray uploads; returns the file-like object to upload and its size"""
+    if image_file.size <= XRAY_COMPRESS_SIZE:
+        return image_file, image_file.size  # Small files go up untouched so lossless originals stay lossless
+
+    try:
+        image = Image.open(image_file)
+        if image.format != "JPEG":
+            # PNG/TIFF scans are often 16-bit grayscale; a lossy 8-bit re-encode would destroy diagnostic detail,
+            # so only photos that are already JPEG are recompressed and everything else goes up as-is
+            image_file.seek(0)
+            return image_file, image_file.size
+
+        image = ImageOps.exif_transpose(image)  # Keep phone photos upright
+        image.thumbnail((XRAY_MAX_DIMENSION, XRAY_MAX_DIMENSION), Image.LANCZOS)
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=88, optimize=True, progressive=True)
+    except Exception:
+        image_file.seek(0)
+        return image_file, image_file.size  # Unreadable by Pillow - let Cloudinary handle the original
+
+    # Cloudinary takes the public ID from the stream's name when use_filename is set
+    buffer.name = os.path.splitext(image_file.name)[0] + ".jpg"
+    size = buffer.tell()
+    buffer.seek(0)
+    return buffer, size
+
+
+def get_patient_xrays():
+    """Return the active patient's X-ray list; uploads and deletes keep it in sync, so no read is needed"""
+    return st.session_state.patient_selected.get("xray_images", [])
+
+def save_xray_image(doctor_email, file_id, image_data):
+    """Append an uploaded X-ray's metadata to the patient record"""
+    try:
+        doctor_reference = database.collection("doctors").document(doctor_email)
+        patient_document = doctor_reference.collection("patients").document(file_id)
+
+        # Append atomically on the server - no read first, and concurrent uploads can't overwrite each other
+        patient_document.update({"xray_images": firestore.ArrayUnion([image_data])})
+        _fetch_patient_cached.clear(doctor_email, file_id)
+        remember_patient(file_id, {"xray_images": get_patient_xrays() + [image_data]})
+        return True
+    except Exception as e:
+        st.error(f"Error saving X-ray data: {str(e)}")
+        return False
+
+
+def delete_xray_image(doctor_email, file_id, xray):
+    """Delete an X-ray from Cloudinary and from the patient record"""
     try:
-        doctor_ref = database.collection("doctors").document(doctor_email)
-        settings_doc = doctor_ref.collection("settings").document("config").get()
+        # Delete from Cloudinary
+        destroy(xray["public_id"])
+
+        # Delete reference from patient record
+        doctor_reference = database.collection("doctors").document(doctor_email)
+        patient_document = doctor_reference.collection("patients").document(file_id)
+
+        # Remove the exact stored entry atomically instead of popping by index from a fresh read
+        patient_document.update({"xray_images": firestore.ArrayRemove([xray])})
+        _fetch_patient_cached.clear(doctor_email, file_id)
+        remember_patient(file_id, {"xray_images": [item for item in get_patient_xrays() if item != xray]})
+        return True
+    except Exception as e:
+        st.error(f"Error deleting X-ray: {str(e)}")
+        return False
+
+
+@st.fragment
+def show_xray_panel(doctor_email, file_id, patient_name):
+    """Render the X-ray gallery and upload form; as a fragment, uploads and deletes rerun only this panel"""
+    # Get patient's existing X-rays
+    patient_xrays = get_patient_xrays()
+
+    # Display existing X-rays
+    if patient_xrays:
+        st.subheader("Existing X-Ray Images")
+
+        # Display images in a grid (3 columns)
+        cols = st.columns(3)
+        for i, xray in enumerate(patient_xrays):
+            with cols[i % 3]:
+                # Use the display-size rendition generated at upload; older images build the URL on the fly
+                img_url = xray.get("display_url")
+                if not img_url:
+                    img_url, options = cloudinary_url(
+                        xray["public_id"],
+                        width=500,
+                        crop="limit",
+                        quality="auto",
+                        fetch_format="auto"
+                    )
+
+                # Display image with caption
+                st.image(img_url, caption=xray.get("caption", f"X-Ray {i+1}"))
+                # The grid only loads the scaled rendition; the original is one click away
+                st.markdown(f"[View full size]({xray['url']})")
+
+                # Add delete button for each image
+                if st.button("🗑️ Delete", key=f"delete_xray_{i}"):
+                    if delete_xray_image(doctor_email, file_id, xray):
+                        st.success("X-Ray deleted successfully!")
+                        st.rerun(scope="fragment")  # Only the gallery needs redrawing
 
-        if settings_doc.exists:
-            return settings_doc.to_dict()
+    # X-ray image upload functionality with Cloudinary
+    with st.container(border=True):
+        st.subheader("Upload New X-Ray")
+
+        # Image upload form
+        with st.form(key="xray_upload_form"):
+            image_file = st.file_uploader("Choose X-Ray Image", type=["jpg", "png", "jpeg"], key="xray_upload")
+            image_caption = st.text_input("Image Caption (Optional)", key="xray_caption")
+
+            submit_upload = st.form_submit_button("Upload X-Ray Image", use_container_width=True)
+            if submit_upload and image_file:
+                try:
+                    # Create unique folder name with doctor email and patient file ID
+                    folder = f"dentistfriend/{doctor_email}/{file_id}"
+
+                    # Upload to Cloudinary
+                    upload_options = {
+                        "folder": folder,
+                        "resource_type": "image",
+                        "use_filename": True,
+                        "unique_filename": True,
+                        "tags": [doctor_email, file_id, patient_name],
+                        # Generate the grid rendition now so the first view is served straight from the CDN
+                        "eager": [{"width": 500, "crop": "limit", "quality": "auto"}]
+                    }
+
+                    # Shrink large photos first, then send anything still large in chunks
+                    image_file.seek(0)
+                    upload_source, upload_size = compress_xray(image_file)
+                    if upload_size > XRAY_CHUNK_SIZE:
+                        upload_result = upload_large(upload_source, chunk_size=XRAY_CHUNK_SIZE, **upload_options)
+                    else:
+                        upload_result = upload(upload_source, **upload_options)
+
+                    # Store image metadata in patient record
+                    image_data = {
+                        "public_id": upload_result["public_id"],
+                        "url": upload_result["secure_url"],
+                        # Cloudinary can return an empty eager list; fall back to the original rather than lose the upload
+                        "display_url": (upload_result.get("eager") or [{}])[0].get("secure_url") or upload_result["secure_url"],
+                        "created_at": upload_result["created_at"],
+                        "caption": image_caption or f"X-Ray for {patient_name}",
+                        "format": upload_result["format"],
+                        "width": upload_result["width"],
+                        "height": upload_result["height"]
+                    }
+
+                    if save_xray_image(doctor_email, file_id, image_data):
+                        st.success("X-Ray uploaded successfully!")
+                        st.rerun(scope="fragment")  # Only the gallery needs redrawing
+                except Exception as e:
+                    st.error(f"Image Upload Error: {str(e)}")
+
+
+@st.fragment
+def show_cost_summary(doctor_email, patient_name, doctor_settings):
+    """Render the cost summary and report export; as a fragment, discount/VAT edits rerun only this tab"""
+    st.header("Cost Summary")
+    # Money is summed in integer cents so totals, discounts and VAT round exactly once
+    total_cents = sum(round(float(item["Cost"]) * 100) for item in st.session_state.treatment_record)
+    total_price = total_cents / 100
+
+    with st.container(border=True):
+        if st.session_state.treatment_record:
+            st.write("**Procedure Cost Details:**")
+
+            # Get currency symbol from doctor settings
+            currency_symbol = get_currency_symbol(doctor_settings.get("currency", "SAR"))
+
+            # Build (tooth, procedure, formatted cost) rows straight from the record, numbered from 1
+            procedure_rows = [
+                (item["Tooth"], item["Procedure"], f"{currency_symbol} {float(item['Cost']):.2f}")
+                for item in st.session_state.treatment_record
+            ]
+            st.table(pd.DataFrame.from_records(
+                procedure_rows,
+                columns=["Tooth", "Procedure", "Cost"],
+                index=range(1, len(procedure_rows) + 1)
+            ))
+
+            # Apply discounts/taxes to the total computed at the top of the tab
+            discount_percent = st.number_input(
+                "Discount Percentage (%)", 
+                min_value=0.0, 
+                max_value=100.0, 
+                step=1.0,
+                format="%.1f", 
+                key="discount_percent"
+            )
+
+            # Calculate discount and tax based on user input
+            discount_cents = round(total_cents * discount_percent / 100)
+            tax_apply = st.checkbox("Apply VAT (15%)", key="tax_apply")
+
+            # Checkbox to include dental images in the PDF report
+            include_images = st.checkbox("Include Dental Imaging in Report", value=True, key="include_images")
+
+            # Calculate final price with VAT and discount
+            tax_cents = round(total_cents * 15 / 100) if tax_apply else 0
+            final_cents = total_cents - discount_cents + tax_cents
+
+            # Back to currency units only for display and the report
+            discount_calculation = discount_cents / 100
+            tax_calculation = tax_cents / 100
+            final_calculation = final_cents / 100
+
+            # Display cost breakdown in table format
+            st.write("**Final Cost Summary:**")
+
+            # Create dynamic cost summary with only applicable entries, as (description, amount) rows
+            summary_rows = [("Total Treatment Cost", f"{currency_symbol} {total_price:.2f}")]
+
+            # Only add discount row if discount is applied
+            if discount_calculation > 0:
+                summary_rows.append((f"Discount ({discount_percent}%)", f"-{currency_symbol} {discount_calculation:.2f}"))
+
+            # Only add VAT row if VAT is applied
+            if tax_apply and tax_calculation > 0:
+                summary_rows.append(("VAT (15%)", f"+{currency_symbol} {tax_calculation:.2f}"))
+
+            # Always add final total
+            summary_rows.append(("Final Total", f"{currency_symbol} {final_calculation:.2f}"))
+
+            st.table(pd.DataFrame.from_records(
+                summary_rows,
+                columns=["Description", "Amount"],
+                index=range(1, len(summary_rows) + 1)
+            ))
+
+            # PDF report generation - creates and downloads treatment plan as PDF
+            if st.button("📄 Generate Treatment Report", use_container_width=True, key="generate_report"):
+                try:
+                    # Get patient's X-ray images if selected
+                    patient_xrays = get_patient_xrays() if include_images else []
+
+                    # Clinic details for the report header come from the (cached) doctor profile
+                    doctor_data = fetch_doctor(doctor_email) or {}
+
+                    # Generate PDF report with treatment details, cost summary and X-rays (if selected).
+                    # Building blocks only this session's script thread, so show progress while X-rays
+                    # download instead of a frozen page
+                    with st.spinner("Generating treatment report..."):
+                        pdf_content = generate_pdf(
+                            st.session_state.get("doctor_name", "Doctor"),
+                            patient_name or "Unknown Patient",
+                            st.session_state.treatment_record,
+                            currency_symbol,
+                            discount_calculation,
+                            tax_calculation,
+                            total_price,
+                            patient_xrays,
+                            doctor_data.get("hospital_name", ""),
+                            doctor_data.get("hospital_address", "")
+                        )
+
+                    # Create download button for the PDF file
+                    # Patient names can hold slashes or spaces, so keep the download name to safe characters
+                    safe_name = UNSAFE_FILENAME_CHARS.sub("_", patient_name or "").strip("_.") or "unknown"
+                    file_name = f"{safe_name}_treatment_plan.pdf"
+                    st.download_button(
+                        label="Download Treatment Report",
+                        use_container_width=True,
+                        data=pdf_content,
+                        file_name=file_name,
+                        mime="application/pdf",
+                        key="download_report"
+                    )
+
+                    st.success(f"Treatment report generated successfully: {file_name}")
+                except Exception as e:
+                    st.error(f"Report Generation Error: {e}")
         else:
-            return {
-                "treatment_procedures": ["Cleaning"],
-                "price_estimates": {"Cleaning": 100},
-                "health_conditions": ["Healthy"],
-                "condition_colors": {"Healthy": "#4CAF50"},
-                "currency": "SAR"
-            }
+            st.info("No procedures have been added to the treatment plan yet")
+
+
+def load_settings(doctor_email):
+    """Load doctor settings from Firestore including treatment procedures, health conditions, and prices"""
+    try:
+        # Cached per doctor; fall back to the defaults until the doctor saves their own settings
+        return fetch_settings(doctor_email) or copy.deepcopy(DEFAULT_SETTINGS)
     except Exception as e:
         st.error(f"Failed to load doctor settings: {str(e)}")
 
@@ -120,9 +440,9 @@ def main():
     doctor_email = st.session_state.get("doctor_email")
     doctor_settings = load_settings(doctor_email)
 
-    # Load dental chart data from config file (teeth map and teeth rows)
-    with open("app/data.json", "r") as file:
-        dental_data = json.load(file)
+    # Dental chart data (teeth map and teeth rows) is parsed once per process and shared;
+    # take a shallow copy so the per-doctor keys below never leak into other sessions
+    dental_data = dict(load_dental_data())
 
     # Merge doctor's treatment procedures and price estimates with dental_data
     dental_data["treatment_procedures"] = doctor_settings.get("treatment_procedures", ["Cleaning"])
@@ -184,27 +504,24 @@ def main():
 
         if register_button:
             if patient_fullname and patient_age and file_id:
-                # Check if patient with same ID already exists to prevent duplicates
-                existing_patient = fetch_patient(st.session_state.doctor_email, file_id)  # Default search_by="id"
-                if existing_patient:
-                    st.error(f"Registration Error: File ID {file_id} already exists in the database")
-                    st.session_state.patient_status = False
+                # Create new patient record with empty dental chart and treatment plan
+                patient_info = {
+                    "name": patient_fullname,
+                    "age": patient_age,
+                    "gender": patient_gender,
+                    "file_id": file_id,
+                    "patient_type": patient_type.lower(),
+                    "dental_chart": {},
+                    "treatment_plan": []
+                }
+                # store_patient rejects a file ID that already exists, preventing duplicates
+                if store_patient(st.session_state.doctor_email, patient_info):
+                    st.session_state.patient_status = True
+                    st.session_state.patient_selected = patient_info
+                    st.session_state.treatment_record = []
+                    st.success(f"Registration Successful: Patient {patient_fullname} added to database")
                 else:
-                    # Create new patient record with empty dental chart and treatment plan
-                    patient_info = {
-                        "name": patient_fullname,
-                        "age": patient_age,
-                        "gender": patient_gender,
-                        "file_id": file_id,
-                        "patient_type": patient_type.lower(),
-                        "dental_chart": {},
-                        "treatment_plan": []
-                    }
-                    if store_patient(st.session_state.doctor_email, patient_info):
-                        st.session_state.patient_status = True
-                        st.session_state.patient_selected = patient_info
-                        st.session_state.treatment_record = []
-                        st.success(f"Registration Successful: Patient {patient_fullname} added to database")
+                    st.session_state.patient_status = False
             else:
                 st.error("Registration Error: All fields are required to complete registration")
                 st.session_state.patient_status = False
@@ -275,10 +592,11 @@ def main():
                     st.session_state.patient_status = False
                     st.session_state.treatment_record = []
 
-                    # Clear tooth condition session state variables
-                    for key in list(st.session_state.keys()):
-                        if key.startswith("tooth_condition_"):
-                            del st.session_state[key]
+                    # Clear tooth condition session state variables; the teeth maps already list every
+                    # possible key, so there's no need to scan the whole session state
+                    for chart in ("adult", "child"):
+                        for tooth in dental_data.get(chart, {}).get("teeth_map", {}):
+                            st.session_state.pop(f"tooth_condition_{tooth}", None)
 
                     st.rerun()  # Refresh the app
             with col2:
@@ -341,16 +659,23 @@ def main():
             dental_chart = patient_info.get("dental_chart", {})
             updated_chart, chart_changed = render_chart(dental_data, dental_chart, doctor_settings)
 
-            # Save dental chart changes to database if changes were made
+            # Stage chart edits per patient instead of writing on every click; they are flushed by
+            # "Save Dental Chart" or together with the next procedure added below. render_chart leaves
+            # patient_info untouched, and only reports a change when a tooth selector was actually edited
             if chart_changed:
-                try:
-                    doctor_reference = database.collection("doctors").document(st.session_state.doctor_email)
-                    patient_document = doctor_reference.collection("patients").document(file_id)
-                    patient_document.update({"dental_chart": updated_chart})
-                    st.session_state.patient_selected["dental_chart"] = updated_chart
-                    st.success("Dental chart updated successfully!")
-                except Exception as e:
-                    st.error(f"Chart Update Error: {str(e)}")
+                st.session_state.pending_chart = (file_id, updated_chart)
+
+            pending_chart = st.session_state.get("pending_chart")
+            if pending_chart and pending_chart[0] != file_id:
+                pending_chart = None  # Left over from a previously selected patient
+
+            # Collect chart and treatment plan changes and write them together once the section has run
+            patient_updates = {}
+            if pending_chart:
+                if st.button("💾 Save Dental Chart", use_container_width=True, key="save_chart"):
+                    patient_updates["dental_chart"] = pending_chart[1]
+                else:
+                    st.caption("The dental chart has unsaved changes")
 
             # Treatment plan creation section - allows adding treatments for specific teeth
             with st.container(border=True):
@@ -359,17 +684,17 @@ def main():
                 # Get patient type to determine which teeth map to use
                 patient_type = st.session_state.patient_selected.get("patient_type", "adult").lower()
 
-                # Use appropriate teeth map based on patient type
+                # Use appropriate teeth map based on patient type; only its tooth numbers are needed here
                 if patient_type == "child" and "child" in dental_data:
-                    teeth_map = dental_data["child"]["teeth_map"].copy()
+                    teeth_keys = list(dental_data["child"]["teeth_map"])
                 else:
-                    teeth_map = dental_data["adult"]["teeth_map"].copy()
+                    teeth_keys = list(dental_data["adult"]["teeth_map"])
 
                 # Default to previously selected tooth or first tooth in map
-                tooth_selected = st.session_state.get("tooth_selected", list(teeth_map.keys())[0])
+                tooth_selected = st.session_state.get("tooth_selected", teeth_keys[0])
                 # If the previously selected tooth is not in the current teeth map, use the first tooth
-                if tooth_selected not in teeth_map:
-                    tooth_selected = list(teeth_map.keys())[0]
+                if tooth_selected not in teeth_keys:
+                    tooth_selected = teeth_keys[0]
 
                 # Form to add new treatment procedures
                 with st.form("treatment_form"):
@@ -378,8 +703,8 @@ def main():
                         # Pre-select the tooth that was marked as unhealthy (if any)
                         tooth_identifier = st.selectbox(
                             "Tooth Number",
-                            list(teeth_map.keys()),
-                            index=list(teeth_map.keys()).index(tooth_selected) if tooth_selected in teeth_map else 0,
+                            teeth_keys,
+                            index=teeth_keys.index(tooth_selected),
                             key="add_tooth"
                         )
 
@@ -417,18 +742,34 @@ def main():
                                 # "End Date": end_date_str
                             }
                             st.session_state.treatment_record.append(new_procedure)
-                            # Update treatment plan in database
-                            if modify_treatment(st.session_state.doctor_email, file_id, st.session_state.treatment_record):
-                                st.success("Procedure added to treatment plan")
+                            # Update treatment plan in database along with any chart change
+                            patient_updates["treatment_plan"] = st.session_state.treatment_record
+                            if pending_chart:
+                                patient_updates["dental_chart"] = pending_chart[1]
                         else:
                             st.error("This procedure already exists for the selected tooth")
 
+                # One round-trip for whatever changed in this run
+                if patient_updates and commit_patient_changes(st.session_state.doctor_email, file_id, patient_updates):
+                    if "dental_chart" in patient_updates:
+                        st.session_state.pop("pending_chart", None)
+                        st.success("Dental chart updated successfully!")
+                    if "treatment_plan" in patient_updates:
+                        st.success("Procedure added to treatment plan")
+
             # Treatment management section - allows editing and updating treatment procedures
             if st.session_state.treatment_record:
                 with st.container(border=True):
                     st.subheader("Treatment Management")
 
-                    df = pd.DataFrame(st.session_state.treatment_record)
+                    treatment_record = st.session_state.treatment_record
+
+                    # Parse every start date in one vectorized pass; missing or malformed dates fall back to today
+                    start_dates = pd.to_datetime(
+                        pd.Series([item.get("Start Date") for item in treatment_record], dtype="object"),
+                        format="%Y-%m-%d",
+                        errors="coerce"
+                    ).fillna(pd.Timestamp.today().normalize())
 
                     # Form for managing treatment procedures - status, duration, etc.
                     with st.form("treatment_management"):
@@ -451,18 +792,21 @@ def main():
 
                         procedures_to_delete = []
 
+                        # Selectbox positions for each procedure, built once instead of a list.index per row
+                        procedure_index = {name: index for index, name in enumerate(dental_data["treatment_procedures"])}
+
                         # Generate row controls for each procedure in the treatment plan
-                        for i, row in df.iterrows():
-                            tooth = row["Tooth"]
-                            procedure = row["Procedure"]
+                        for i, (item, start_date) in enumerate(zip(treatment_record, start_dates)):
+                            tooth = item["Tooth"]
+                            procedure = item["Procedure"]
                             key_id = f"{tooth}_{procedure}_{i}"
 
                             # Get current tooth condition from updated chart or existing record
-                            tooth_condition = updated_chart.get(tooth, row.get("Condition", "Healthy"))
+                            tooth_condition = updated_chart.get(tooth, item.get("Condition", "Healthy"))
 
                             # Update condition in the treatment record if it changed in the dental chart
-                            if "Condition" in row and row["Condition"] != tooth_condition:
-                                st.session_state.treatment_record[i]["Condition"] = tooth_condition
+                            if "Condition" in item and item["Condition"] != tooth_condition:
+                                item["Condition"] = tooth_condition
 
                             cols = st.columns([2, 2, 2, 3, 1])
 
@@ -476,8 +820,7 @@ def main():
                                 new_procedure = st.selectbox(
                                     "Procedure",
                                     dental_data["treatment_procedures"],
-                                    index=dental_data["treatment_procedures"].index(procedure)
-                                        if procedure in dental_data["treatment_procedures"] else 0,
+                                    index=procedure_index.get(procedure, 0),
                                     key=f"procedure_{key_id}",
                                     label_visibility="collapsed"
                                 )
@@ -492,18 +835,10 @@ def main():
                             #     )
 
                             with cols[3]:
-                                # Individual start date for each procedure
-                                # Parse the existing date or use today's date as default
-                                default_date = datetime.today()
-                                if "Start Date" in row and row["Start Date"]:
-                                    try:
-                                        default_date = datetime.strptime(row["Start Date"], "%Y-%m-%d")
-                                    except (ValueError, TypeError):
-                                        pass  # Use today's date if parsing fails
-
+                                # Individual start date for each procedure, parsed above
                                 procedure_start_date = st.date_input(
                                     "Start Date",
-                                    value=default_date,
+                                    value=start_date.date(),
                                     key=f"start_date_{key_id}",
                                     label_visibility="collapsed"
                                 )
@@ -547,10 +882,11 @@ def main():
                                 # Create updated procedure record
                                 updated_procedure = {
                                     "Tooth": tooth,
-                                    "Condition": tooth_condition,
+                                    "Condition": item.get("Condition", "Healthy"),
                                     "Procedure": new_procedure,
                                     "Cost": procedure_price,
-                                    # "Status": st.session_state[f"status_{key_id}"],
+                                    # The status selectbox is disabled, so carry the stored status over
+                                    "Status": item.get("Status", "Pending"),
                                     # "Duration": st.session_state[f"duration_{key_id}"],
                                     "Start Date": start_date_str
                                 }
@@ -578,7 +914,9 @@ def main():
 
                         # Format dates for better readability
                         if "Start Date" in schedule_df.columns:
-                            schedule_df["Start Date"] = schedule_df["Start Date"].apply(format_date)
+                            # Vectorized parse/format; values that aren't ISO dates are shown as stored
+                            start_dates = pd.to_datetime(schedule_df["Start Date"], format="%Y-%m-%d", errors="coerce")
+                            schedule_df["Start Date"] = start_dates.dt.strftime("%B %d, %Y").fillna(schedule_df["Start Date"])
 
                         # if "End Date" in schedule_df.columns:
                         #     schedule_df["End Date"] = schedule_df["End Date"].apply(format_date)
@@ -598,249 +936,11 @@ def main():
             st.header("Dental Imaging")
             configure_cloudinary()
 
-            def get_patient_xrays(doctor_email, file_id):
-                try:
-                    doctor_reference = database.collection("doctors").document(doctor_email)
-                    patient_document = doctor_reference.collection("patients").document(file_id)
-                    patient_data = patient_document.get().to_dict()
-                    return patient_data.get("xray_images", [])
-                except Exception as e:
-                    st.error(f"Error fetching X-rays: {str(e)}")
-                    return []
-
-            def save_xray_image(doctor_email, file_id, image_data):
-                try:
-                    doctor_reference = database.collection("doctors").document(doctor_email)
-                    patient_document = doctor_reference.collection("patients").document(file_id)
-
-                    # Get existing images or initialize empty list
-                    patient_data = patient_document.get().to_dict()
-                    xray_images = patient_data.get("xray_images", [])
-
-                    # Add new image data
-                    xray_images.append(image_data)
-
-                    # Update patient record
-                    patient_document.update({"xray_images": xray_images})
-                    return True
-                except Exception as e:
-                    st.error(f"Error saving X-ray data: {str(e)}")
-                    return False
-
-            # Function to delete X-ray from Cloudinary and patient record
-            def delete_xray_image(doctor_email, file_id, public_id, index):
-                try:
-                    # Delete from Cloudinary
-                    destroy(public_id)
-
-                    # Delete reference from patient record
-                    doctor_reference = database.collection("doctors").document(doctor_email)
-                    patient_document = doctor_reference.collection("patients").document(file_id)
-
-                    # Get existing images
-                    patient_data = patient_document.get().to_dict()
-                    xray_images = patient_data.get("xray_images", [])
-
-                    # Remove image at specified index
-                    if 0 <= index < len(xray_images):
-                        xray_images.pop(index)
-                        patient_document.update({"xray_images": xray_images})
-                        return True
-                    return False
-                except Exception as e:
-                    st.error(f"Error deleting X-ray: {str(e)}")
-                    return False
-
-            # Get patient's existing X-rays
-            doctor_email = st.session_state.doctor_email
-            file_id = patient_info["file_id"]
-            patient_xrays = get_patient_xrays(doctor_email, file_id)
-
-            # Display existing X-rays
-            if patient_xrays:
-                st.subheader("Existing X-Ray Images")
-
-                # Display images in a grid (3 columns)
-                cols = st.columns(3)
-                for i, xray in enumerate(patient_xrays):
-                    with cols[i % 3]:
-                        # Generate optimized URL with transformations if needed
-                        img_url, options = cloudinary_url(
-                            xray["public_id"],
-                            width=500,
-                            crop="scale",
-                            quality="auto",
-                            fetch_format="auto"
-                        )
-
-                        # Display image with caption
-                        st.image(img_url, caption=xray.get("caption", f"X-Ray {i+1}"))
-
-                        # Add delete button for each image
-                        if st.button("🗑️ Delete", key=f"delete_xray_{i}"):
-                            if delete_xray_image(doctor_email, file_id, xray["public_id"], i):
-                                st.success("X-Ray deleted successfully!")
-                                st.rerun()
-
-            # X-ray image upload functionality with Cloudinary
-            with st.container(border=True):
-                st.subheader("Upload New X-Ray")
-
-                # Image upload form
-                with st.form(key="xray_upload_form"):
-                    image_file = st.file_uploader("Choose X-Ray Image", type=["jpg", "png", "jpeg"], key="xray_upload")
-                    image_caption = st.text_input("Image Caption (Optional)", key="xray_caption")
-
-                    submit_upload = st.form_submit_button("Upload X-Ray Image", use_container_width=True)
-                    if submit_upload and image_file:
-                        try:
-                            # Create unique folder name with doctor email and patient file ID
-                            folder = f"dentistfriend/{doctor_email}/{file_id}"
-
-                            # Upload to Cloudinary
-                            upload_result = upload(
-                                image_file,
-                                folder=folder,
-                                resource_type="image",
-                                use_filename=True,
-                                unique_filename=True,
-                                tags=[doctor_email, file_id, patient_info["name"]]
-                            )
-
-                            # Store image metadata in patient record
-                            image_data = {
-                                "public_id": upload_result["public_id"],
-                                "url": upload_result["secure_url"],
-                                "created_at": upload_result["created_at"],
-                                "caption": image_caption or f"X-Ray for {patient_info['name']}",
-                                "format": upload_result["format"],
-                                "width": upload_result["width"],
-                                "height": upload_result["height"]
-                            }
-
-                            if save_xray_image(doctor_email, file_id, image_data):
-                                st.success("X-Ray uploaded successfully!")
-                                st.rerun()
-                        except Exception as e:
-                            st.error(f"Image Upload Error: {str(e)}")
+            show_xray_panel(st.session_state.doctor_email, file_id, patient_info["name"])
 
         # Tab 3: Cost Summary
         with tab3:
-            st.header("Cost Summary")
-            total_price = sum(item["Cost"] for item in st.session_state.treatment_record)
-            discount_calculation = 0
-            tax_calculation = 0
-            final_calculation = total_price
-
-            with st.container(border=True):
-                if st.session_state.treatment_record:
-                    cost_df = pd.DataFrame(st.session_state.treatment_record)
-
-                    st.write("**Procedure Cost Details:**")
-                    procedure_details = cost_df[["Tooth", "Procedure", "Cost"]]
-                    # Reset index to start from 1 instead of 0
-                    procedure_details.index = range(1, len(procedure_details) + 1)
-
-                    # Get currency symbol from doctor settings
-                    currency_symbol = get_currency_symbol(doctor_settings.get("currency", "SAR"))
-
-                    # Format cost as string with currency symbol and 2 decimal places
-                    procedure_details = procedure_details.copy()
-                    procedure_details["Cost"] = procedure_details["Cost"].astype(float).apply(lambda x: f"{currency_symbol} {x:.2f}")
-
-                    st.table(procedure_details)
-
-                    # Calculate total price and apply discounts/taxes
-                    total_price = sum(item["Cost"] for item in st.session_state.treatment_record)
-
-                    discount_percent = st.number_input(
-                        "Discount Percentage (%)", 
-                        min_value=0.0, 
-                        max_value=100.0, 
-                        step=1.0,
-                        format="%.1f", 
-                        key="discount_percent"
-                    )
-
-                    # Calculate discount and tax based on user input
-                    discount_calculation = total_price * (discount_percent / 100)
-                    tax_apply = st.checkbox("Apply VAT (15%)", key="tax_apply")
-
-                    # Checkbox to include dental images in the PDF report
-                    include_images = st.checkbox("Include Dental Imaging in Report", value=True, key="include_images")
-
-                    # Calculate final price with VAT and discount
-                    tax_calculation = total_price * 0.15 if tax_apply else 0
-                    final_calculation = total_price - discount_calculation + tax_calculation
-
-                    # Display cost breakdown in table format
-                    st.write("**Final Cost Summary:**")
-
-                    # Create dynamic cost summary with only applicable entries
-                    descriptions = ["Total Treatment Cost"]
-                    amounts = [f"{currency_symbol} {total_price:.2f}"]
-
-                    # Only add discount row if discount is applied
-                    if discount_calculation > 0:
-                        descriptions.append(f"Discount ({discount_percent}%)")
-                        amounts.append(f"-{currency_symbol} {discount_calculation:.2f}")
-
-                    # Only add VAT row if VAT is applied
-                    if tax_apply and tax_calculation > 0:
-                        descriptions.append("VAT (15%)")
-                        amounts.append(f"+{currency_symbol} {tax_calculation:.2f}")
-
-                    # Always add final total
-                    descriptions.append("Final Total")
-                    amounts.append(f"{currency_symbol} {final_calculation:.2f}")
-
-                    cost_summary = {
-                        "Description": descriptions,
-                        "Amount": amounts
-                    }
-                    summary_df = pd.DataFrame(cost_summary)
-                    summary_df.index = range(1, len(summary_df) + 1)
-                    st.table(summary_df)
-
-                    # PDF report generation - creates and downloads treatment plan as PDF
-                    if st.button("📄 Generate Treatment Report", use_container_width=True, key="generate_report"):
-                        try:
-                            # Get patient's X-ray images if selected
-                            patient_xrays = get_patient_xrays(doctor_email, file_id) if include_images else []
-
-                            # Generate PDF report with treatment details, cost summary and X-rays (if selected)
-                            pdf_path = generate_pdf(
-                                st.session_state.get("doctor_name", "Doctor"),
-                                patient_info["name"] or "Unknown Patient",
-                                st.session_state.treatment_record,
-                                currency_symbol,
-                                discount_calculation,
-                                tax_calculation,
-                                total_price,
-                                patient_xrays
-                            )
-
-                            # Read generated PDF for download
-                            with open(pdf_path, "rb") as file_handler:
-                                pdf_content = file_handler.read()
-
-                            # Create download button for the PDF file
-                            file_name = f"{patient_info['name'] or 'unknown'}_treatment_plan.pdf"
-                            st.download_button(
-                                label="Download Treatment Report",
-                                use_container_width=True,
-                                data=pdf_content,
-                                file_name=file_name,
-                                mime="application/pdf",
-                                key="download_report"
-                            )
-
-                            st.success(f"Treatment report generated successfully: {file_name}")
-                        except Exception as e:
-                            st.error(f"Report Generation Error: {e}")
-                else:
-                    st.info("No procedures have been added to the treatment plan yet")
-
+            show_cost_summary(st.session_state.doctor_email, patient_info["name"], doctor_settings)
 
 main()
 show_footer()
@@ -1,132 +1,216 @@
 import os
 import smtplib
+import threading
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
-from datetime import datetime
+import plotly.graph_objects as go
+from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from firebase_admin import firestore
-from dotenv import load_dotenv
-from utils import format_date, show_footer
+from google.api_core.exceptions import AlreadyExists
+from google.rpc import code_pb2
+from utils import format_date, show_footer, get_db, fetch_doctor, run_parallel
 
-load_dotenv()
-
-database = firestore.client()
+database = get_db()
 doctor_email = st.session_state["doctor_email"] if "doctor_email" in st.session_state else None
-stock_collection = database.collection("doctors").document(doctor_email).collection("stock") if doctor_email else None
+# Resolve the doctor's document and stock references once per run and share them across every handler
+doctor_reference = database.collection("doctors").document(doctor_email) if doctor_email else None
+stock_collection = doctor_reference.collection("stock") if doctor_email else None
+
+# Imports stream through Firestore's BulkWriter, flushed every IMPORT_FLUSH_SIZE writes to report progress
+IMPORT_FLUSH_SIZE = 500
+IMPORT_WRITE_ATTEMPTS = 5
+IMPORT_CHUNK_ROWS = 5000
+
+# A test alert waits this long for its result; background alerts are polled every ALERT_POLL_SECONDS until they finish
+ALERT_SEND_TIMEOUT = 30
+ALERT_POLL_SECONDS = 2
+
+# Order used to surface the most urgent items first
+STATUS_PRIORITY = {"Expired": 0, "Out of Stock": 1, "Low Stock": 2, "Expiring Soon": 3, "Normal": 4}
 
 
-def fetch_stock():
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_stock(doctor_email):
     """Fetch all inventory items from Firestore database"""
-    stock_documents = stock_collection.stream()
+    # Cached per doctor so a reload or second tab reuses the last read; any stock write clears it
+    stock_documents = get_db().collection("doctors").document(doctor_email).collection("stock").stream()
     return {doc.id: doc.to_dict() for doc in stock_documents}
 
 
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_inventory_frame(inventory_data, today):
+    """Derive display columns and status for every inventory item in one vectorized pass"""
+    # Cached on the inventory contents and the date, so reruns that only move a slider reuse the parsed frame
+    inventory_df = pd.DataFrame.from_dict(inventory_data, orient="index").reindex(
+        columns=["quantity", "expiry_date", "low_threshold", "category", "location"])
+
+    # Base name is the item ID without its _expiry suffix
+    names = inventory_df.index.to_series().str.split("_").str[0]
+    expiry = pd.to_datetime(inventory_df["expiry_date"], format="%Y-%m-%d", errors="coerce")
+    days_left = (expiry - pd.Timestamp(today)).dt.days
+    quantity = inventory_df["quantity"]
+
+    inventory_df["Item"] = names.str.title()
+    inventory_df["Quantity"] = quantity
+    inventory_df["Category"] = inventory_df["category"].fillna("")
+    inventory_df["Location"] = inventory_df["location"].fillna("")
+    # Unparseable dates are shown as stored, like format_date does
+    inventory_df["Expiry Date"] = expiry.dt.strftime("%B %d, %Y").fillna(inventory_df["expiry_date"])
+    inventory_df["Days Until Expiry"] = days_left.astype("Int64")
+    inventory_df["Display Name"] = names.str.capitalize() + " (" + expiry.dt.strftime("%b %d, %Y") + ")"
+
+    # First matching condition wins, mirroring the override order of the original status checks
+    inventory_df["Status"] = np.select(
+        [quantity == 0, days_left <= 0, quantity <= inventory_df["low_threshold"].fillna(5), days_left <= 30],
+        ["Out of Stock", "Expired", "Low Stock", "Expiring Soon"],
+        default="Normal"
+    )
+    return inventory_df
+
+
+def remember_stock(item_id, fields):
+    """Mirror saved fields onto the session's inventory copy so later reruns don't need to re-read the collection"""
+    inventory_data = st.session_state.setdefault("inventory_data", {})
+    inventory_data.setdefault(item_id, {}).update(fields)
+    fetch_stock.clear(doctor_email)
+
+
+def forget_stock(item_id):
+    """Drop a deleted item from the session's inventory copy"""
+    st.session_state.get("inventory_data", {}).pop(item_id, None)
+    fetch_stock.clear(doctor_email)
+
+
 def store_stock(item_name, item_quantity, expiry_date, low_threshold=5, category="", location=""):
     """Store or update inventory item in Firestore database"""
-    item_doc = stock_collection.document(item_name).get()
-    if item_doc.exists:
-        st.warning(f"Item '{item_name.split('_')[0]}' with the same expiry date already exists. Please edit the existing item instead.")
-        return False
-
-    stock_collection.document(item_name).set({
+    item_fields = {
         "quantity": item_quantity,
         "expiry_date": expiry_date,
         "low_threshold": low_threshold,
         "category": category,
         "location": location
-    }, merge=True)
+    }
+
+    try:
+        # create() fails if the item already exists, so the duplicate check and the write are one atomic call
+        stock_collection.document(item_name).create(item_fields)
+    except AlreadyExists:
+        st.warning(f"Item '{item_name.split('_')[0]}' with the same expiry date already exists. Please edit the existing item instead.")
+        return False
+
+    remember_stock(item_name, item_fields)
     return True
 
 
+@firestore.transactional
+def decrement_stock(transaction, item_reference, quantity_remove):
+    """Subtract units inside a transaction and return the new quantity, or None if the item is gone"""
+    item_document = item_reference.get(transaction=transaction)
+    if not item_document.exists:
+        return None
+
+    new_quantity = item_document.get("quantity") - quantity_remove
+    transaction.update(item_reference, {"quantity": new_quantity})
+    return new_quantity
+
+
 def modify_stock(item_name, quantity_remove):
     """Decrease quantity or remove item from inventory"""
-    item_reference = stock_collection.document(item_name)
-    item_document = item_reference.get()
+    # Read and write in one transaction so concurrent edits from another tab can't be lost
+    new_quantity = decrement_stock(database.transaction(), stock_collection.document(item_name), quantity_remove)
 
-    if item_document.exists:
-        item_data = item_document.to_dict()
-        current_quantity = item_data["quantity"]
-
-        # Update quantity if there are enough units
-        item_reference.update({"quantity": current_quantity - quantity_remove})
+    if new_quantity is not None:
         st.success(f"Quantity Updated: {quantity_remove} units of '{item_name}' removed")
 
         # Immediately update the inventory data in session state
-        st.session_state.inventory_data = fetch_stock()
+        remember_stock(item_name, {"quantity": new_quantity})
+
+
+def write_stock_items(items, progress=None):
+    """Create (item_id, fields) pairs through a BulkWriter; returns the IDs that failed after retries and those that already existed"""
+    # BulkWriter sends writes in parallel, ramps up throughput within Firestore's limits and retries with backoff
+    bulk_writer = database.bulk_writer()
+    failed_ids = {}
+    duplicate_ids = set()
+
+    def retry_write(failure, writer):
+        # Runs on the writer's own thread, so it only records the failure
+        if failure.code == code_pb2.ALREADY_EXISTS:
+            # Added from another tab or session since this one loaded its stock; retrying can never succeed
+            duplicate_ids.add(failure.operation.reference.id)
+            return False
+        if failure.attempts < IMPORT_WRITE_ATTEMPTS:
+            return True
+        failed_ids[failure.operation.reference.id] = failure.message
+        return False
+
+    bulk_writer.on_write_error(retry_write)
+
+    for position, (item_id, item_fields) in enumerate(items, start=1):
+        # create() fails on an existing document, like store_stock, so an import never overwrites stock it didn't see
+        bulk_writer.create(stock_collection.document(item_id), item_fields)
+        # Flush periodically so the progress bar can advance from the script thread
+        if position % IMPORT_FLUSH_SIZE == 0 or position == len(items):
+            bulk_writer.flush()
+            if progress is not None:
+                progress.progress(position / len(items), text=f"Writing {position} of {len(items)} items")
+    bulk_writer.close()
+
+    # Mirror the rows that landed into the session copy
+    for item_id, item_fields in items:
+        if item_id not in failed_ids and item_id not in duplicate_ids:
+            remember_stock(item_id, item_fields)
+    return failed_ids, duplicate_ids
 
 
 def import_inventory(file):
     """Process imported CSV or Excel file and add items to inventory"""
     try:
-        # Determine file type and read accordingly
+        # Determine file type and read accordingly; CSVs stream in chunks so only one chunk is in memory at a time
         if file.name.endswith('.csv'):
-            df = pd.read_csv(file)
+            chunks = pd.read_csv(file, chunksize=IMPORT_CHUNK_ROWS)
         elif file.name.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(file)
+            chunks = [pd.read_excel(file)]
         else:
             return False, "Unsupported file format. Please upload a CSV or Excel file."
 
-        # Check if the file has the required columns
-        required_columns = ["Item", "Quantity", "Expiry Date", "Low Threshold"]
-        missing_columns = [col for col in required_columns if col not in df.columns]
-
-        if missing_columns:
-            return False, f"Missing required columns: {', '.join(missing_columns)}"
-
-        # Process each row and add to inventory
         success_count = 0
         error_count = 0
         errors = []
+        # Existing items come from the session copy, so duplicates are caught without a read per row
+        existing_ids = set(st.session_state.get("inventory_data", {}))
+        progress = st.progress(0.0, text="Importing items...")
+
+        for df in chunks:
+            # Check if the file has the required columns
+            required_columns = ["Item", "Quantity", "Expiry Date", "Low Threshold"]
+            missing_columns = [col for col in required_columns if col not in df.columns]
+
+            if missing_columns:
+                progress.empty()
+                return False, f"Missing required columns: {', '.join(missing_columns)}"
+
+            # Validate each row of the chunk, then write its valid rows together
+            pending_items = []
+            error_count += collect_import_rows(df, existing_ids, pending_items, errors)
+
+            if pending_items:
+                failed_ids, duplicate_ids = write_stock_items(pending_items, progress)
+                success_count += len(pending_items) - len(failed_ids) - len(duplicate_ids)
+                error_count += len(failed_ids) + len(duplicate_ids)
+                errors.extend(f"Item '{item_id}' could not be saved: {message}" for item_id, message in failed_ids.items())
+
+                # Rows the session copy didn't know about yet are reported like any other duplicate
+                pending_fields = dict(pending_items)
+                errors.extend(
+                    f"Item '{item_id.rsplit('_', 1)[0]}' with expiry date {pending_fields[item_id]['expiry_date']} already exists"
+                    for item_id in duplicate_ids
+                )
 
-        for index, row in df.iterrows():
-            try:
-                # Extract values and convert to appropriate types
-                item_name = str(row["Item"]).strip().lower()
-                quantity = int(row["Quantity"])
-
-                expiry_date = row["Expiry Date"]
-                if isinstance(expiry_date, str):
-                    try:
-                        # Standard format "Month DD, YYYY"
-                        expiry_date = datetime.strptime(expiry_date, "%B %d, %Y").strftime("%Y-%m-%d")
-                    except ValueError:
-                        errors.append(f"Row {index+1}: Invalid date format for {item_name}. Use 'Month DD, YYYY' format.")
-                        error_count += 1
-                        continue
-                else:
-                    # Convert pandas timestamp to string format
-                    expiry_date = pd.Timestamp(expiry_date).strftime("%Y-%m-%d")
-
-                # Get low threshold from the required column
-                try:
-                    low_threshold = int(row["Low Threshold"])
-                    if low_threshold < 1:
-                        errors.append(f"Row {index+1}: Low Threshold must be at least 1 for {item_name}")
-                        error_count += 1
-                        continue
-                except (ValueError, TypeError):
-                    errors.append(f"Row {index+1}: Invalid Low Threshold value for {item_name}")
-                    error_count += 1
-                    continue
-                
-                # Generate a unique item ID based on name and expiry date
-                item_id = f"{item_name}_{expiry_date}"
-
-                # Get optional columns if they exist
-                category = str(row.get("Category", "")).strip() if "Category" in df.columns else ""
-                location = str(row.get("Location", "")).strip() if "Location" in df.columns else ""
-                
-                # Add item to inventory
-                success = store_stock(item_id, quantity, expiry_date, low_threshold, category, location)
-                if success:
-                    success_count += 1
-                else:
-                    error_count += 1
-                    errors.append(f"Row {index+1}: Item '{item_name}' with expiry date {expiry_date} already exists")
-
-            except Exception as e:
-                error_count += 1
-                errors.append(f"Row {index+1}: {str(e)}")
+        progress.empty()
 
         # Return import results
         if error_count == 0:
@@ -141,8 +225,141 @@ def import_inventory(file):
         return False, f"Error processing file: {str(e)}"
 
 
-def send_alert(email, expiry_items, days_threshold):
-    """Send email alert for items nearing expiry"""
+def collect_import_rows(df, existing_ids, pending_items, errors):
+    """Validate one chunk of imported rows, queueing valid items and returning the number of rejected rows"""
+    error_count = 0
+
+    # Names, dates and IDs are derived column-wise for the whole chunk before the row loop
+    item_names = df["Item"].astype(str).str.strip().str.lower()
+    raw_expiry = df["Expiry Date"]
+    is_text = raw_expiry.map(type) == str
+    # Text dates use the standard "Month DD, YYYY" format; spreadsheet cells arrive as timestamps already
+    text_expiry = pd.to_datetime(raw_expiry.where(is_text), format="%B %d, %Y", errors="coerce")
+    cell_expiry = pd.to_datetime(raw_expiry.where(~is_text), errors="coerce")
+    expiry_dates = text_expiry.where(is_text, cell_expiry).dt.strftime("%Y-%m-%d")
+    # Generate a unique item ID based on name and expiry date
+    item_ids = item_names + "_" + expiry_dates
+
+    # Get optional columns if they exist
+    categories = df["Category"].astype(str).str.strip() if "Category" in df.columns else pd.Series("", index=df.index)
+    locations = df["Location"].astype(str).str.strip() if "Location" in df.columns else pd.Series("", index=df.index)
+
+    rows = zip(df.index, df["Quantity"], df["Low Threshold"], item_names, expiry_dates, is_text, item_ids, categories, locations)
+    for index, raw_quantity, raw_threshold, item_name, expiry_date, expiry_is_text, item_id, category, location in rows:
+        try:
+            # Convert quantity to the stored integer type
+            quantity = int(raw_quantity)
+
+            if pd.isna(expiry_date):
+                if expiry_is_text:
+                    errors.append(f"Row {index+1}: Invalid date format for {item_name}. Use 'Month DD, YYYY' format.")
+                else:
+                    errors.append(f"Row {index+1}: Invalid expiry date for {item_name}")
+                error_count += 1
+                continue
+
+            # Get low threshold from the required column
+            try:
+                low_threshold = int(raw_threshold)
+                if low_threshold < 1:
+                    errors.append(f"Row {index+1}: Low Threshold must be at least 1 for {item_name}")
+                    error_count += 1
+                    continue
+            except (ValueError, TypeError):
+                errors.append(f"Row {index+1}: Invalid Low Threshold value for {item_name}")
+                error_count += 1
+                continue
+
+            # Queue item for the batched write
+            if item_id in existing_ids:
+                error_count += 1
+                errors.append(f"Row {index+1}: Item '{item_name}' with expiry date {expiry_date} already exists")
+                continue
+
+            existing_ids.add(item_id)
+            pending_items.append((item_id, {
+                "quantity": quantity,
+                "expiry_date": expiry_date,
+                "low_threshold": low_threshold,
+                "category": category,
+                "location": location
+            }))
+
+        except Exception as e:
+            error_count += 1
+            errors.append(f"Row {index+1}: {str(e)}")
+
+    return error_count
+
+
+@st.cache_resource
+def get_mail_executor():
+    """Shared worker pool that sends alert emails off the script thread"""
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def deliver_mail(mailer, sender, password, recipient, message):
+    """Send a message over the session's SMTP connection, reconnecting if the server dropped it"""
+    # Runs on a worker thread, so the connection lives in a plain dict rather than being read from session state
+    with mailer["lock"]:
+        server = mailer["server"]
+        try:
+            if server is None:
+                raise smtplib.SMTPServerDisconnected("not connected")
+            # Cheap keepalive probe before reusing the connection
+            server.noop()
+        except (smtplib.SMTPException, OSError):
+            # Release the dead socket before replacing it
+            if server is not None:
+                server.close()
+                mailer["server"] = None
+            # Implicit TLS on 465 saves the STARTTLS round trip
+            server = smtplib.SMTP_SSL("smtp.gmail.com", 465, timeout=15)
+            server.login(user=sender, password=password)
+            mailer["server"] = server
+
+        server.sendmail(from_addr=sender, to_addrs=recipient, msg=message)
+
+
+def close_mail(mailer):
+    """Log out of the session's SMTP connection, if it still has one"""
+    with mailer["lock"]:
+        server, mailer["server"] = mailer["server"], None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+
+def report_alert_results():
+    """Surface the outcome of alert emails that finished sending since the last run"""
+    pending = st.session_state.get("pending_alerts", [])
+    for future, alert_email, is_automatic in [entry for entry in pending if entry[0].done()]:
+        pending.remove((future, alert_email, is_automatic))
+        error = future.exception()
+        if error is None:
+            st.toast(f"Email alert sent to {alert_email}", icon="✅")
+        else:
+            st.toast(f"Failed to send email alert: {error}", icon="❌")
+            # Let the automatic alert try again on a later run
+            if is_automatic:
+                st.session_state["email_alert_sent"] = False
+
+    # Nothing left in flight, so don't keep a logged-in Gmail socket open for this session
+    mailer = st.session_state.get("_smtp")
+    if not pending and mailer is not None and mailer["server"] is not None:
+        get_mail_executor().submit(close_mail, mailer)
+
+
+@st.fragment(run_every=ALERT_POLL_SECONDS)
+def poll_alert_results():
+    """Report background alert sends as they finish, without waiting for the doctor to interact"""
+    report_alert_results()
+
+
+def send_alert(email, expiry_items, days_threshold, is_automatic=False):
+    """Queue an email alert for items nearing expiry; the result is reported by report_alert_results"""
     ADMIN_EMAIL = os.getenv("ADMIN_EMAIL")
     ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
 
@@ -248,15 +465,11 @@ Dentist Friend
     message.attach(MIMEText(plain_text, "plain"))
     message.attach(MIMEText(html_content, "html"))
 
-    try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(user=ADMIN_EMAIL, password=ADMIN_PASSWORD)
-        server.sendmail(from_addr=ADMIN_EMAIL, to_addrs=email, msg=message.as_string())
-        server.quit()
-        return "Email alert sent successfully"
-    except Exception as e:
-        return str(e)
+    # One SMTP connection per session, reused across alerts instead of a fresh TLS login each time
+    mailer = st.session_state.setdefault("_smtp", {"lock": threading.Lock(), "server": None})
+    future = get_mail_executor().submit(deliver_mail, mailer, ADMIN_EMAIL, ADMIN_PASSWORD, email, message.as_string())
+    st.session_state.setdefault("pending_alerts", []).append((future, email, is_automatic))
+    return future
 
 
 def main():
@@ -272,34 +485,41 @@ def main():
             st.session_state.clear()
             st.rerun()
 
-    # Initialize inventory data in session state if not already present
+    # Read the stock collection once per session; every write below keeps this copy in sync.
+    # The doctor profile is warmed alongside it so the alerts tab doesn't wait on a second round trip
     if 'inventory_data' not in st.session_state:
-        st.session_state.inventory_data = fetch_stock()
+        st.session_state.inventory_data, _ = run_parallel((fetch_stock, doctor_email), (fetch_doctor, doctor_email))
+
+    # Derive dates and statuses once per rerun (against a single "today") and share them across all three tabs.
+    # Each tab is a fragment, so widget changes inside one tab rerun only that tab;
+    # anything that writes stock calls st.rerun() to rebuild all three from fresh data
+    inventory_data = st.session_state.inventory_data
+    today = date.today()
+    inventory_df = build_inventory_frame(inventory_data, today.isoformat()) if inventory_data else None
 
     # Create the main tabs
     tab_inventory, tab_alerts, tab_reports = st.tabs(["Inventory", "Alerts", "Reports"])
 
     # Tab 1: Inventory
     with tab_inventory:
-        # Refresh inventory data on each run to ensure it's up-to-date
-        st.session_state.inventory_data = fetch_stock()
-        display_inventory()
+        display_inventory(inventory_df, today)
 
     # Tab 2: Alerts
     with tab_alerts:
-        display_alerts()
+        display_alerts(inventory_df)
 
     # Tab 3: Reports
     with tab_reports:
-        display_reports()
+        display_reports(inventory_df, today)
 
 
-def display_inventory():
+@st.fragment
+def display_inventory(inventory_df, today):
     """Display and manage the inventory tab"""
     st.header("Current Inventory")
 
     # Display full inventory table first
-    show_inventory()
+    show_inventory(inventory_df)
 
     # Inventory management options below the table
     st.subheader("Inventory Management")
@@ -309,12 +529,12 @@ def display_inventory():
     with col_add:
         with st.container(border=True):
             st.subheader("Add Inventory", divider="blue")
-            add_items()
+            add_items(today)
 
     with col_edit:
         with st.container(border=True):
             st.subheader("Edit Inventory", divider="orange")
-            edit_inventory()
+            edit_inventory(today)
 
     with st.container(border=True):
         st.subheader("Import Inventory", divider="green")
@@ -349,8 +569,6 @@ def display_inventory():
                 success, message = import_inventory(uploaded_file)
                 if success:
                     st.success(message)
-                    # Force refresh of inventory data
-                    st.session_state.inventory_data = fetch_stock()
                     # Reset email sent flag when adding new items that might trigger alerts
                     st.session_state["email_alert_sent"] = False
                     st.rerun()
@@ -358,14 +576,44 @@ def display_inventory():
                     st.error(message)
 
 
-def display_alerts():
+@st.cache_data(max_entries=16, show_spinner=False)
+def low_stock_figure(low_stock_df):
+    """Bar chart of items below their threshold, cached on the table contents"""
+    # Built from graph objects directly, skipping plotly express's DataFrame copy on every slider move
+    fig = go.Figure(go.Bar(
+        x=low_stock_df["Item"],
+        y=low_stock_df["Quantity"],
+        marker=dict(color=low_stock_df["Quantity"], colorscale="Reds", reversescale=True, showscale=True,
+                    colorbar=dict(title="Quantity")),
+        customdata=low_stock_df[["Threshold", "Expiry Date"]],
+        hovertemplate="Item=%{x}<br>Quantity=%{y}<br>Threshold=%{customdata[0]}<br>Expiry Date=%{customdata[1]}<extra></extra>"
+    ))
+    fig.update_layout(title="Items Below Threshold", xaxis_title="Item", yaxis_title="Quantity")
+    return fig
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def expiry_figure(expiry_df, days_threshold):
+    """Bar chart of days left for items near expiry, cached on the table contents and threshold"""
+    fig = go.Figure(go.Bar(
+        x=expiry_df["Item"],
+        y=expiry_df["Days Left"],
+        marker=dict(color=expiry_df["Days Left"], colorscale="RdYlGn", showscale=True,
+                    colorbar=dict(title="Days Left")),
+        hovertemplate="Item=%{x}<br>Days Left=%{y}<extra></extra>"
+    ))
+    fig.update_layout(title=f"Items Expiring Within {days_threshold} Days", xaxis_title="Item", yaxis_title="Days Until Expiry")
+    return fig
+
+
+@st.fragment
+def display_alerts(inventory_df):
     """Display alerts tab with expiry and low stock warnings"""
     st.header("Inventory Alerts")
 
-    # Initialize email alert related session states
-    doctor_doc = database.collection("doctors").document(doctor_email).get()
-    if doctor_doc.exists:
-        doctor_data = doctor_doc.to_dict()
+    # Initialize email alert related session states (profile is cached and cleared on every alert setting write)
+    doctor_data = fetch_doctor(doctor_email)
+    if doctor_data is not None:
         if "alert_email" in doctor_data and doctor_data["alert_email"]:
             st.session_state["enable_email_alerts"] = True
             st.session_state["alert_email"] = doctor_data["alert_email"]
@@ -377,10 +625,8 @@ def display_alerts():
     if "email_alert_sent" not in st.session_state:
         st.session_state["email_alert_sent"] = False
 
-    # Use inventory data from session state
-    inventory_data = st.session_state.inventory_data
-
-    if not inventory_data:
+    if inventory_df is None:
+        report_alert_results()
         st.info("No inventory items found. Please add items in the Inventory tab.")
         return
 
@@ -392,38 +638,17 @@ def display_alerts():
             global_threshold = st.slider("Global Low Stock Threshold", min_value=1, max_value=50, value=5)
 
             # Find items below threshold quantity (using item-specific threshold when available)
-            low_stock_items = []
-            for item_id, details in inventory_data.items():
-                # Get the item-specific threshold or use the global one
-                item_threshold = details.get("low_threshold", global_threshold)
-                if details["quantity"] <= item_threshold:
-                    # Extract base name from item_id
-                    item_name = item_id.split('_')[0] if '_' in item_id else item_id
-                    expiry_date = details["expiry_date"]
-                    low_stock_items.append({
-                        "Item": item_name.title(),
-                        "Quantity": details["quantity"],
-                        "Threshold": item_threshold,
-                        "Expiry Date": format_date(expiry_date)
-                    })
+            item_thresholds = inventory_df["low_threshold"].fillna(global_threshold).astype(int)
+            low_stock_df = inventory_df.loc[inventory_df["Quantity"] <= item_thresholds, ["Item", "Quantity", "Expiry Date"]]
+            low_stock_df.insert(2, "Threshold", item_thresholds[low_stock_df.index])
+            low_stock_df = low_stock_df.reset_index(drop=True)
 
-            if low_stock_items:
+            if not low_stock_df.empty:
                 st.markdown("### 🚨 Low Stock Items")
-                low_stock_df = pd.DataFrame(low_stock_items)
                 st.dataframe(low_stock_df, use_container_width=True)
 
                 # Create a visualization of low stock items
-                fig = px.bar(
-                    low_stock_df,
-                    x="Item",
-                    y="Quantity",
-                    title="Items Below Threshold",
-                    color="Quantity",
-                    color_continuous_scale="Reds_r",
-                    hover_data=["Threshold", "Expiry Date"]
-                )
-                fig.update_layout(xaxis_title="Item", yaxis_title="Quantity")
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(low_stock_figure(low_stock_df), use_container_width=True)
             else:
                 st.success("✅ All items have sufficient quantity")
 
@@ -433,58 +658,37 @@ def display_alerts():
             # Expiry alert settings and display
             days_threshold = st.slider("Days Until Expiry Warning", min_value=1, max_value=180, value=30)
 
-            # Calculate days until expiry for each item
-            today = datetime.today().date()
-            expiry_items = []
-
-            for item, details in inventory_data.items():
-                try:
-                    expiry_date = datetime.strptime(details["expiry_date"], "%Y-%m-%d").date()
-                    days_until_expiry = (expiry_date - today).days
-
-                    # Add items expiring within threshold days
-                    if days_until_expiry <= days_threshold:
-                        # Extract base name from item
-                        item_name = item.split('_')[0] if '_' in item else item
-                        expiry_items.append({
-                            "Item": item_name.title(),
-                            "Quantity": details["quantity"],
-                            "Expiry Date": format_date(details["expiry_date"]),
-                            "Days Left": days_until_expiry
-                        })
-                except ValueError as e:
-                    st.error(f"Date format error for item '{item}': {str(e)}")
-                    continue
+            # Items whose stored date couldn't be parsed have no days left
+            days_left = inventory_df["Days Until Expiry"]
+            for item in inventory_df.index[days_left.isna()]:
+                st.error(f"Date format error for item '{item}': expected YYYY-MM-DD, got '{inventory_df.at[item, 'expiry_date']}'")
+
+            # Add items expiring within threshold days
+            expiring = inventory_df[(days_left <= days_threshold).fillna(False)]
+            expiry_df = pd.DataFrame({
+                "Item": expiring["Item"],
+                "Quantity": expiring["Quantity"],
+                "Expiry Date": expiring["Expiry Date"],
+                "Days Left": expiring["Days Until Expiry"].astype(int)
+            }).sort_values("Days Left").reset_index(drop=True)
+            expiry_items = expiry_df.to_dict("records")
 
             # Check if we need to send email alerts
             if expiry_items and st.session_state.get("enable_email_alerts", False) and not st.session_state["email_alert_sent"]:
                 alert_email = st.session_state.get("alert_email")
                 if alert_email:
-                    result = send_alert(alert_email, expiry_items, days_threshold)
-                    if "successfully" in result:
-                        st.session_state["email_alert_sent"] = True
-                        st.success(f"Email alert sent to {alert_email}")
-                    else:
-                        st.error(f"Failed to send email alert: {result}")
+                    # Sent in the background; marked as sent now so reruns don't queue duplicates
+                    send_alert(alert_email, expiry_items, days_threshold, is_automatic=True)
+                    st.session_state["email_alert_sent"] = True
+                    st.toast(f"Sending email alert to {alert_email}...")
 
             if expiry_items:
                 st.markdown("### ⚠️ Items Near Expiry")
-                expiry_df = pd.DataFrame(expiry_items)
-                expiry_df = expiry_df.sort_values("Days Left")
                 st.dataframe(expiry_df, use_container_width=True)
 
                 # Create a visualization for expiry alerts
                 if len(expiry_df) > 0:
-                    fig = px.bar(
-                        expiry_df,
-                        x="Item",
-                        y="Days Left",
-                        title=f"Items Expiring Within {days_threshold} Days",
-                        color="Days Left",
-                        color_continuous_scale="RdYlGn",
-                    )
-                    fig.update_layout(xaxis_title="Item", yaxis_title="Days Until Expiry")
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.plotly_chart(expiry_figure(expiry_df, days_threshold), use_container_width=True)
             else:
                 st.success("✅ No items are nearing expiration")
                 # Reset email sent flag when there are no items to alert about
@@ -507,9 +711,10 @@ def display_alerts():
             # Set the document in Firestore as soon as alert is enabled
             if doctor_email:
                 try:
-                    database.collection("doctors").document(doctor_email).set({
+                    doctor_reference.set({
                         "alert_email": st.session_state["alert_email"]
                     }, merge=True)
+                    fetch_doctor.clear(doctor_email)
                 except Exception as e:
                     st.error(f"Failed to save alert settings: {str(e)}")
             else:
@@ -522,9 +727,10 @@ def display_alerts():
         if not enable_email_alerts and previous_email_alert_state:
             if doctor_email:
                 try:
-                    database.collection("doctors").document(doctor_email).update({
+                    doctor_reference.update({
                         "alert_email": firestore.DELETE_FIELD
                     })
+                    fetch_doctor.clear(doctor_email)
                 except Exception as e:
                     st.error(f"Failed to update alert settings: {str(e)}")
             else:
@@ -553,9 +759,10 @@ def display_alerts():
                         # Update the alert email in Firestore
                         if doctor_email:
                             try:
-                                database.collection("doctors").document(doctor_email).set({
+                                doctor_reference.set({
                                     "alert_email": alert_email
                                 }, merge=True)
+                                fetch_doctor.clear(doctor_email)
                                 # Reset email sent flag when changing email
                                 st.session_state["email_alert_sent"] = False
                                 st.success(f"Email updated: Alerts will be sent to {alert_email}")
@@ -570,36 +777,47 @@ def display_alerts():
                     st.error("Please enter a valid email address")
                 elif expiry_items:
                     try:
-                        result = send_alert(alert_email, expiry_items, days_threshold)
-                        if "successfully" in result:
-                            st.success(f"Test email alert sent to {alert_email}")
-                        else:
-                            st.error(f"Failed to send test email alert: {result}")
+                        future = send_alert(alert_email, expiry_items, days_threshold)
                     except Exception as e:
-                        st.error(f"Error sending test email: {str(e)}")
+                        st.toast(f"Error sending test email: {str(e)}", icon="❌")
+                    else:
+                        # The doctor asked for this one, so wait for its outcome instead of reporting it later
+                        try:
+                            with st.spinner(f"Sending test email alert to {alert_email}..."):
+                                future.result(timeout=ALERT_SEND_TIMEOUT)
+                        except FutureTimeout:
+                            st.toast(f"Test email alert to {alert_email} is still sending...")
+                        except Exception:
+                            pass  # The failure is reported from the finished future just below
+                        report_alert_results()
                 else:
                     st.warning("No items are near expiry. Add items that will expire soon to test the alert.")
 
+    # Background sends report themselves as they finish; the poller only runs while something is in flight
+    if st.session_state.get("pending_alerts"):
+        poll_alert_results()
 
-def display_reports():
-    """Display reports tab with analytics and export options"""
-    st.header("Inventory Reports")
 
-    # Use inventory data from session state
-    inventory_data = st.session_state.inventory_data
+@st.cache_data(max_entries=8, show_spinner=False)
+def build_export_files(inventory_df):
+    """Serialize the inventory report as CSV and JSON, cached until the inventory changes"""
+    export_df = inventory_df[["Item", "Quantity", "Category", "Location", "Expiry Date", "Days Until Expiry", "Status"]].copy()
+    export_df["Low Threshold"] = inventory_df["low_threshold"].fillna(5).astype(int)
+    return export_df.to_csv(index=False), export_df.to_json(orient="records")
 
-    if inventory_data:
-        # Prepare data for visualization
-        today = datetime.today().date()
-        inventory_records = []
 
+@st.fragment
+def display_reports(inventory_df, today):
+    """Display reports tab with analytics and export options"""
+    st.header("Inventory Reports")
+
+    if inventory_df is not None:
         st.subheader("Summary Statistics", divider="blue")
 
         # Calculate total items, units, and items expiring soon
-        total_items = len(inventory_data)
-        total_units = sum(item["quantity"] for item in inventory_data.values())
-        expiring_soon = sum(1 for item, details in inventory_data.items()
-                            if (datetime.strptime(details["expiry_date"], "%Y-%m-%d").date() - today).days <= 30)
+        total_items = len(inventory_df)
+        total_units = int(inventory_df["Quantity"].sum())
+        expiring_soon = int((inventory_df["Days Until Expiry"] <= 30).sum())
 
         # Create metrics row
         metric_col1, metric_col2, metric_col3 = st.columns(3)
@@ -612,29 +830,8 @@ def display_reports():
 
         st.subheader("Inventory Visualizations", divider="green")
 
-        for item_id, details in inventory_data.items():
-            # Extract base name from item_id
-            item_name = item_id.split('_')[0] if '_' in item_id else item_id
-            item_name = item_name.capitalize()
-
-            # Format the expiry date
-            expiry_date = datetime.strptime(details["expiry_date"], "%Y-%m-%d").date()
-            formatted_date = expiry_date.strftime("%b %d, %Y")
-
-            # Create display name for charts
-            display_name = f"{item_name} ({formatted_date})"
-            days_until_expiry = (expiry_date - today).days
-
-            inventory_records.append({
-                "Item": item_name.title(),  # Base name for grouping
-                "Display Name": display_name,  # Formatted name with date
-                "Quantity": details["quantity"],
-                "Category": details.get("category", ""),
-                "Location": details.get("location", ""),
-                "Days Until Expiry": days_until_expiry
-            })
-
-        viz_df = pd.DataFrame(inventory_records)
+        # Display name carries the formatted expiry date; Item is the base name for grouping
+        viz_df = inventory_df[["Item", "Display Name", "Quantity", "Category", "Location", "Days Until Expiry"]]
 
         # Create a dashboard with visualizations
         col1, col2 = st.columns(2)
@@ -674,7 +871,7 @@ def display_reports():
                 st.plotly_chart(fig2, use_container_width=True)
 
         # Add pie chart for inventory distribution
-        if len(inventory_data) > 0:
+        if len(viz_df) > 0:
             st.subheader("Inventory Distribution")
 
             # For pie chart, use the display name with formatted date
@@ -692,98 +889,39 @@ def display_reports():
 
             st.plotly_chart(fig3, use_container_width=True)
 
-        # Generate inventory records for export
-        if 'inventory_records' in st.session_state:
-            report_df = pd.DataFrame(st.session_state.inventory_records)
-
-            # Export options
-            st.subheader("Export Options", divider="blue")
-
-            export_df = report_df.copy()
-            export_df['Low Threshold'] = [st.session_state.inventory_data.get(item_id, {}).get('low_threshold', 5) 
-                                          for item_id in report_df['ID']]
-
-            if 'ID' in export_df.columns:
-                export_df = export_df.drop(columns=['ID'])
-
-            export_col1, export_col2 = st.columns(2)
-            with export_col1:
-                csv = export_df.to_csv(index=False)
-                st.download_button(
-                    label="📄 Download CSV Report",
-                    data=csv,
-                    file_name=f"inventory_report_{datetime.today().strftime('%Y-%m-%d')}.csv",
-                    mime="text/csv",
-                    use_container_width=True
-                )
+        # Export options
+        st.subheader("Export Options", divider="blue")
 
-            with export_col2:
-                json_data = export_df.to_json(orient="records")
-                st.download_button(
-                    label="📄 Download JSON Report",
-                    data=json_data,
-                    file_name=f"inventory_report_{datetime.today().strftime('%Y-%m-%d')}.json",
-                    mime="application/json",
-                    use_container_width=True
-                )
+        csv, json_data = build_export_files(inventory_df)
+
+        export_col1, export_col2 = st.columns(2)
+        with export_col1:
+            st.download_button(
+                label="📄 Download CSV Report",
+                data=csv,
+                file_name=f"inventory_report_{today.isoformat()}.csv",
+                mime="text/csv",
+                use_container_width=True
+            )
+
+        with export_col2:
+            st.download_button(
+                label="📄 Download JSON Report",
+                data=json_data,
+                file_name=f"inventory_report_{today.isoformat()}.json",
+                mime="application/json",
+                use_container_width=True
+            )
     else:
         st.info("No inventory data available. Add items in the Inventory tab to generate reports.")
 
 
-def show_inventory():
+def show_inventory(inventory_df):
     """Display the current inventory status with conditional formatting"""
-    # Always refresh inventory data from session state
-    inventory_data = st.session_state.inventory_data
-
-    if inventory_data:
-        st.session_state.inventory_records = []
-        for item_id, details in inventory_data.items():
-            # Extract base name from item_id
-            item_name = item_id.split('_')[0] if '_' in item_id else item_id
-
-            # Calculate days until expiry
-            today = datetime.today().date()
-            expiry_date = datetime.strptime(details["expiry_date"], "%Y-%m-%d").date()
-            days_until_expiry = (expiry_date - today).days
-            quantity = details["quantity"]
-
-            # Get the item-specific threshold
-            item_threshold = details.get("low_threshold", 5)
-
-            # Determine status
-            status = "Normal"
-            if days_until_expiry <= 30:
-                status = "Expiring Soon"
-            if quantity <= item_threshold:
-                status = "Low Stock"
-            if days_until_expiry <= 0:
-                status = "Expired"
-            if quantity == 0:
-                status = "Out of Stock"
-
-            st.session_state.inventory_records.append({
-                "Item": item_name.title(),
-                "Quantity": details["quantity"],
-                "Category": details.get("category", ""),
-                "Location": details.get("location", ""),
-                "Expiry Date": format_date(details["expiry_date"]),
-                "Days Until Expiry": days_until_expiry,
-                "Status": status,
-                "ID": item_id  # Store the original ID for reference
-            })
-
-        # Create DataFrame and sort by status priority
-        inventory_df = pd.DataFrame(st.session_state.inventory_records)
-
-        # Custom sorting function to prioritize alerts
-        def status_priority(status):
-            priorities = {"Expired": 0, "Out of Stock": 1, "Low Stock": 2, "Expiring Soon": 3, "Normal": 4}
-            return priorities.get(status, 4)
-
-        # Sort the DataFrame by status priority
-        inventory_df["Status Priority"] = inventory_df["Status"].apply(status_priority)
-        inventory_df = inventory_df.sort_values("Status Priority")
-        display_df = inventory_df.drop(columns=["Status Priority", "ID"])
+    if inventory_df is not None:
+        # Sort by status priority so alerts come first
+        inventory_df = inventory_df.iloc[inventory_df["Status"].map(STATUS_PRIORITY).argsort(kind="stable")]
+        display_df = inventory_df[["Item", "Quantity", "Category", "Location", "Expiry Date", "Days Until Expiry", "Status"]]
 
         # Initialize the active filter in session state if it doesn't exist
         if "active_filter" not in st.session_state:
@@ -850,37 +988,37 @@ def show_inventory():
         with filter_col1:
             if st.button("All Items", key="all_items", use_container_width=True, type=get_button_style("All Items")):
                 st.session_state.active_filter = "All Items"
-                st.rerun()
+                st.rerun(scope="fragment")  # Only the inventory tab depends on the filter
 
         with filter_col2:
             if st.button("Normal", key="normal", use_container_width=True, type=get_button_style("Normal")):
                 st.session_state.active_filter = "Normal"
-                st.rerun()
+                st.rerun(scope="fragment")  # Only the inventory tab depends on the filter
 
         with filter_col3:
             if st.button("Low Stock", key="low_stock", use_container_width=True, type=get_button_style("Low Stock")):
                 st.session_state.active_filter = "Low Stock"
-                st.rerun()
+                st.rerun(scope="fragment")  # Only the inventory tab depends on the filter
 
         with filter_col4:
             if st.button("Expiring Soon", key="expiring_soon", use_container_width=True, type=get_button_style("Expiring Soon")):
                 st.session_state.active_filter = "Expiring Soon"
-                st.rerun()
+                st.rerun(scope="fragment")  # Only the inventory tab depends on the filter
 
         with filter_col5:
             if st.button("Expired", key="expired", use_container_width=True, type=get_button_style("Expired")):
                 st.session_state.active_filter = "Expired"
-                st.rerun()
+                st.rerun(scope="fragment")  # Only the inventory tab depends on the filter
 
         with filter_col6:
             if st.button("Out of Stock", key="out_of_stock", use_container_width=True, type=get_button_style("Out of Stock")):
                 st.session_state.active_filter = "Out of Stock"
-                st.rerun()
+                st.rerun(scope="fragment")  # Only the inventory tab depends on the filter
     else:
         st.info("Inventory Status: No items currently in stock")
 
 
-def add_items():
+def add_items(today):
     """Add new items to inventory or update existing items"""
     column_first, column_second, column_third = st.columns(3)
     with column_first:
@@ -895,7 +1033,7 @@ def add_items():
     # Second row for expiry, category, and location
     col_expiry, col_category, col_location = st.columns(3)
     with col_expiry:
-        expiry_date = st.date_input("Expiry Date", min_value=datetime.today().date())
+        expiry_date = st.date_input("Expiry Date", min_value=today)
     
     with col_category:
         item_category = st.text_input("Category", placeholder="e.g., Surgical, Cleaning, Medication").strip()
@@ -921,14 +1059,44 @@ def add_items():
 
                     # Reset email sent flag when adding new items that might trigger alerts
                     st.session_state["email_alert_sent"] = False
-                    # Force refresh of inventory data
-                    st.session_state.inventory_data = fetch_stock()
                     st.rerun()
         else:
             st.error("Entry Error: Please enter a valid item name")
 
 
-def edit_inventory():
+@st.cache_resource(max_entries=16, show_spinner=False)
+def build_search_index(item_ids):
+    """Index every three-letter slice of each item's base name; shared read-only, so callers must not modify it"""
+    # cache_resource hands back the same object instead of unpickling a copy of the index on every search
+    names = {}
+    trigrams = {}
+    for item_id in item_ids:
+        # Extract the base name from the item_id (removing the _date suffix)
+        name = item_id.split('_')[0].lower()
+        names[item_id] = name
+        for start in range(len(name) - 2):
+            trigrams.setdefault(name[start:start + 3], set()).add(item_id)
+    return names, trigrams
+
+
+def search_stock(search_term, inventory_data):
+    """Return (item_id, base name) pairs whose name contains the search term, in item ID order"""
+    # Names only depend on the IDs, so the index is keyed on those and rebuilt only when items are added or removed
+    names, trigrams = build_search_index(tuple(inventory_data))
+
+    if len(search_term) < 3:
+        # Too short to use the index; fall back to checking every name
+        candidates = names
+    else:
+        # An item can only contain the term if it contains every one of the term's three-letter slices
+        candidates = set.intersection(*(trigrams.get(search_term[start:start + 3], set())
+                                        for start in range(len(search_term) - 2)))
+
+    # Confirm the full substring on the (usually small) candidate set
+    return [(item_id, names[item_id]) for item_id in sorted(candidates) if search_term in names[item_id]]
+
+
+def edit_inventory(today):
     """Edit or remove items from inventory"""
     search_term = st.text_input("Item to Edit", placeholder="Enter item name to edit").strip().lower()
     find_edit_button = st.button("🔍 Find Item", use_container_width=True)
@@ -945,19 +1113,16 @@ def edit_inventory():
 
         # Find all items that contain the search term (partial match)
         matching_items = {}
-        for item_id, details in st.session_state.inventory_data.items():
-            # Extract the base name from the item_id (removing the _date suffix)
-            name_part = item_id.split('_')[0] if '_' in item_id else item_id
-            
-            # Check if search term appears anywhere in the name (partial match)
-            if search_term in name_part:
-                # Add to matching items with expiry date as key info
-                matching_items[item_id] = {
-                    "name": name_part,
-                    "expiry_date": details["expiry_date"],
-                    "quantity": details["quantity"],
-                    "low_threshold": details.get("low_threshold", 5)
-                }
+        inventory_data = st.session_state.inventory_data
+        for item_id, name_part in search_stock(search_term, inventory_data):
+            details = inventory_data[item_id]
+            # Add to matching items with expiry date as key info
+            matching_items[item_id] = {
+                "name": name_part,
+                "expiry_date": details["expiry_date"],
+                "quantity": details["quantity"],
+                "low_threshold": details.get("low_threshold", 5)
+            }
 
         if not matching_items:
             st.error(f"Item Not Found: No items containing '{search_term}' found in inventory")
@@ -981,26 +1146,25 @@ def edit_inventory():
             st.session_state.edit_item_id = edit_item
         # If multiple matching items, show dropdown
         else:
-            item_options = []
-            for item_id, details in matching_items.items():
-                display_text = f"{details['name']} (Expires: {format_date(details['expiry_date'])}) - {details['quantity']} units"
-                item_options.append({"id": item_id, "display": display_text})
+            # Map each item ID to its label so the selection resolves back to an ID directly
+            item_options = {
+                item_id: f"{details['name']} (Expires: {format_date(details['expiry_date'])}) - {details['quantity']} units"
+                for item_id, details in matching_items.items()
+            }
 
-            selected_option = st.selectbox(
+            # Get the selected item ID
+            edit_item = st.selectbox(
                 "Select Item to Edit",
-                options=[item["display"] for item in item_options],
+                options=list(item_options),
+                format_func=item_options.get,
                 index=0,
                 key="item_selector"
             )
-
-            # Get the selected item ID
-            selected_index = item_options.index(next(item for item in item_options if item["display"] == selected_option))
-            edit_item = item_options[selected_index]["id"]
             st.session_state.edit_item_id = edit_item
 
         # Handle item editing
         if edit_item and edit_item in st.session_state.inventory_data:
-            handle_item_editing(edit_item)
+            handle_item_editing(edit_item, today)
         elif "edit_item_id" in st.session_state:
             st.error("The selected item no longer exists in the inventory.")
             st.session_state.edit_search_mode = False
@@ -1008,7 +1172,17 @@ def edit_inventory():
             st.session_state.pop("matching_items", None)
 
 
-def handle_item_editing(edit_item):
+def finish_item_edit():
+    """Leave edit mode after a save or delete and redraw every tab from the updated inventory"""
+    # Reset email sent flag since the change might alter which items trigger alerts
+    st.session_state["email_alert_sent"] = False
+    # Clear all session state variables related to editing
+    st.session_state.pop("edit_item_id", None)
+    st.session_state.pop("matching_items", None)
+    st.rerun()
+
+
+def handle_item_editing(edit_item, today):
     """Handle the editing interface for a specific inventory item"""
     item_details = st.session_state.inventory_data[edit_item]
     base_name = edit_item.split('_')[0] if '_' in edit_item else edit_item
@@ -1029,8 +1203,7 @@ def handle_item_editing(edit_item):
 
     with edit_col2:
         try:
-            current_expiry = datetime.strptime(item_details['expiry_date'], "%Y-%m-%d").date()
-            today = datetime.today().date()
+            current_expiry = date.fromisoformat(item_details["expiry_date"])
             if current_expiry < today:
                 current_expiry = today
 
@@ -1041,7 +1214,7 @@ def handle_item_editing(edit_item):
             )
         except Exception as e:
             st.error(f"Date validation error: {e}")
-            new_expiry = datetime.today().date()
+            new_expiry = today
 
     with edit_col3:
         new_threshold = st.number_input(
@@ -1083,62 +1256,48 @@ def handle_item_editing(edit_item):
                     st.error(f"Cannot update: An item with name '{base_name}' and expiry date {format_date(expiry_string)} already exists")
                 else:
                     # Create new item with updated expiry
-                    stock_collection.document(new_item_id).set({
+                    item_fields = {
                         "quantity": new_quantity,
                         "expiry_date": expiry_string,
                         "low_threshold": new_threshold,
                         "category": new_category,
                         "location": new_location
-                    }, merge=True)
-                    # Delete old item
-                    stock_collection.document(edit_item).delete()
+                    }
+                    # Write the new item and delete the old one in a single atomic batch,
+                    # so a failure can't leave both copies behind
+                    batch = database.batch()
+                    batch.set(stock_collection.document(new_item_id), item_fields, merge=True)
+                    batch.delete(stock_collection.document(edit_item))
+                    batch.commit()
+                    remember_stock(new_item_id, item_fields)
+                    forget_stock(edit_item)
                     st.success(f"Item Updated with new expiry: '{base_name}' has been updated successfully")
 
-                    # Reset email sent flag when editing items that might trigger alerts
-                    st.session_state["email_alert_sent"] = False
-                    # Clear session state
-                    st.session_state.pop("edit_item_id", None)
-                    st.session_state.pop("matching_items", None)
-                    # Force refresh of inventory data
-                    st.session_state.inventory_data = fetch_stock()
-                    st.rerun()
+                    finish_item_edit()
             else:
                 # Update existing item
-                stock_collection.document(edit_item).set({
+                item_fields = {
                     "quantity": new_quantity,
                     "expiry_date": expiry_string,
                     "low_threshold": new_threshold,
                     "category": new_category,
                     "location": new_location
-                }, merge=True)
+                }
+                stock_collection.document(edit_item).set(item_fields, merge=True)
+                remember_stock(edit_item, item_fields)
                 st.success(f"Item Updated: '{base_name}' has been updated successfully")
 
-                # Reset email sent flag when editing items that might trigger alerts
-                st.session_state["email_alert_sent"] = False
-                # Clear session state
-                st.session_state.pop("edit_item_id", None)
-                st.session_state.pop("matching_items", None)
-                # Force refresh of inventory data
-                st.session_state.inventory_data = fetch_stock()
-                st.rerun()
+                finish_item_edit()
 
     with col2:
         if st.button("🗑️ Delete Item", use_container_width=True, key="delete_item"):
             # Directly delete the item and clear state in one go
             try:
                 stock_collection.document(edit_item).delete()
+                forget_stock(edit_item)
                 st.success(f"Item Removed: '{base_name}' (Expires: {format_date(item_details['expiry_date'])}) has been deleted from inventory")
 
-                # Reset email sent flag when deleting items that might change alert status
-                st.session_state["email_alert_sent"] = False
-
-                # Clear all session state variables related to editing
-                st.session_state.pop("edit_item_id", None)
-                st.session_state.pop("matching_items", None)
-
-                # Force refresh of inventory data
-                st.session_state.inventory_data = fetch_stock()
-                st.rerun()
+                finish_item_edit()
             except Exception as e:
                 st.error(f"Error deleting item: {str(e)}")
 
@@ -1,11 +1,8 @@
 import os
 import smtplib
 import streamlit as st
-from dotenv import load_dotenv
 from utils import show_footer
 
-load_dotenv()
-
 
 def contact_us():
     st.markdown("# Contact Us")
@@ -1,11 +1,15 @@
-import json
+import copy
 import streamlit as st
 from firebase_admin import firestore
-from utils import show_footer, get_currency_symbol
+from google.cloud.firestore_v1.field_path import FieldPath
+from utils import show_footer, get_currency_symbol, get_db, fetch_doctor, fetch_settings, DEFAULT_SETTINGS
 
-# Load default data from JSON file
-with open("app/data.json", "r") as file:
-    default_data = json.load(file)
+# Currencies offered in settings, with their display labels
+CURRENCY_OPTIONS = {
+    "SAR": "Saudi Riyal (SAR)",
+    "INR": "Indian Rupee (₹)"
+}
+CURRENCY_KEYS = tuple(CURRENCY_OPTIONS)
 
 
 def main():
@@ -21,7 +25,7 @@ def main():
             st.session_state.clear()
             st.rerun()
 
-    database = firestore.client()
+    database = get_db()
     doctor_email = st.session_state.get("doctor_email")
     doctor_settings = load_settings(database, doctor_email)
 
@@ -44,21 +48,12 @@ def main():
 def load_settings(database, doctor_email):
     """Load doctor settings from Firestore or create default settings if none exist."""
     try:
-        doctor_ref = database.collection("doctors").document(doctor_email)
-        settings_doc = doctor_ref.collection("settings").document("config").get()
+        # Cached per doctor and cleared by save_settings
+        settings = fetch_settings(doctor_email)
 
-        # Check if settings document exists
-        if settings_doc.exists:
-            settings = settings_doc.to_dict()
-        else:
-            # Create default settings if none exist
-            settings = {
-                "treatment_procedures": ["Cleaning"],
-                "price_estimates": {"Cleaning": 100},
-                "health_conditions": ["Healthy"],
-                "condition_colors": {"Healthy": "#4CAF50"},
-                "currency": "SAR"
-            }
+        # Create default settings if none exist
+        if settings is None:
+            settings = copy.deepcopy(DEFAULT_SETTINGS)
             save_settings(database, doctor_email, settings)
 
         return settings
@@ -69,8 +64,23 @@ def load_settings(database, doctor_email):
 def save_settings(database, doctor_email, settings):
     """Save updated settings to Firestore database."""
     try:
+        # Replace the whole settings map on the doctor document so removed entries don't linger
+        doctor_ref = database.collection("doctors").document(doctor_email)
+        doctor_ref.update({"settings": settings})
+        fetch_doctor.clear(doctor_email)
+        fetch_settings.clear(doctor_email)
+    except Exception as e:
+        st.error(f"Settings save failed: {e}")
+
+
+def save_settings_fields(database, doctor_email, updates):
+    """Update only the given settings fields, keyed by path tuples such as ("price_estimates", "Cleaning")."""
+    try:
+        # FieldPath quotes names containing dots or spaces so each procedure/condition stays a single key
         doctor_ref = database.collection("doctors").document(doctor_email)
-        doctor_ref.collection("settings").document("config").set(settings)
+        doctor_ref.update({FieldPath("settings", *path).to_api_repr(): value for path, value in updates.items()})
+        fetch_doctor.clear(doctor_email)
+        fetch_settings.clear(doctor_email)
     except Exception as e:
         st.error(f"Settings save failed: {e}")
 
@@ -84,48 +94,63 @@ def show_treatments(database, doctor_email, doctor_settings):
     procedures = doctor_settings.get("treatment_procedures", [])
     prices = doctor_settings.get("price_estimates", {})
 
-    # Display existing procedures with their prices
+    # Display existing procedures with their prices; edits are held in a form until applied
     if procedures:
-        for i, procedure in enumerate(procedures):
-            cols = st.columns([4, 3, 1])
-            with cols[0]:
-                st.text(f"Procedure {i+1}")
-                new_name = st.text_input(
-                    "",
-                    value=procedure, 
-                    key=f"procedure_{i}",
-                    label_visibility="collapsed"
-                ).title()
-                procedures[i] = new_name
-
-            with cols[1]:
-                st.text(f"Price ({doctor_settings.get('currency', 'SAR')})")
-                price = prices.get(procedure, 0)
-                new_price = st.number_input(
-                    "",
-                    min_value=0.0,
-                    value=float(price),
-                    step=10.0,
-                    format="%.2f",
-                    key=f"price_{procedure}",
-                    label_visibility="collapsed"
-                )
-                if new_price != price:
-                    prices[procedure] = new_price
-
-            with cols[2]:
-                st.write("")
-                st.write("")
-                if st.button("❌", key=f"delete_procedure_{i}"):
-                    procedures.pop(i)
-                    if procedure in prices:
-                        prices.pop(procedure)
-
-                    # Update settings and save to database
-                    doctor_settings["treatment_procedures"] = procedures
-                    doctor_settings["price_estimates"] = prices
-                    save_settings(database, doctor_email, doctor_settings)
-                    st.success("Treatment procedure removed successfully")
+        with st.form("procedures_form", border=False):
+            rows = []
+            for i, procedure in enumerate(procedures):
+                cols = st.columns([4, 3, 1])
+                with cols[0]:
+                    st.text(f"Procedure {i+1}")
+                    new_name = st.text_input(
+                        "",
+                        value=procedure, 
+                        key=f"procedure_{i}",
+                        label_visibility="collapsed"
+                    ).title().strip()
+
+                with cols[1]:
+                    st.text(f"Price ({doctor_settings.get('currency', 'SAR')})")
+                    price = prices.get(procedure, 0)
+                    new_price = st.number_input(
+                        "",
+                        min_value=0.0,
+                        value=float(price),
+                        step=10.0,
+                        format="%.2f",
+                        key=f"price_{procedure}",
+                        label_visibility="collapsed"
+                    )
+
+                with cols[2]:
+                    st.text("Remove")
+                    remove = st.checkbox("❌", key=f"delete_procedure_{i}", label_visibility="collapsed")
+
+                rows.append((procedure, new_name, new_price, price, remove))
+
+            if st.form_submit_button("✔️ Apply Changes", use_container_width=True):
+                kept_names = [new_name for procedure, new_name, new_price, price, remove in rows if not remove]
+
+                if not all(kept_names):
+                    st.error("Procedure names cannot be empty")
+                elif len(set(kept_names)) != len(kept_names):
+                    st.error("Each procedure name can only appear once")
+                else:
+                    # One update: the new list, prices for renamed or re-priced rows, and deletes for names that are gone
+                    updates = {("treatment_procedures",): kept_names}
+                    for procedure in procedures:
+                        if procedure not in kept_names:
+                            updates[("price_estimates", procedure)] = firestore.DELETE_FIELD
+                    for procedure, new_name, new_price, price, remove in rows:
+                        if not remove and (new_name != procedure or new_price != price):
+                            updates[("price_estimates", new_name)] = new_price
+                    save_settings_fields(database, doctor_email, updates)
+
+                    # Row widgets are keyed by position, so reset them before the list shifts
+                    for i in range(len(procedures)):
+                        st.session_state.pop(f"procedure_{i}", None)
+                        st.session_state.pop(f"delete_procedure_{i}", None)
+                    st.success("Treatment procedures updated successfully")
                     st.rerun()
     else:
         st.caption("No procedures added yet.")
@@ -159,11 +184,10 @@ def show_treatments(database, doctor_email, doctor_settings):
             if new_procedure:
                 # Check if procedure already exists to avoid duplicates
                 if new_procedure not in procedures:
-                    procedures.append(new_procedure)
-                    prices[new_procedure] = new_price
-                    doctor_settings["treatment_procedures"] = procedures
-                    doctor_settings["price_estimates"] = prices
-                    save_settings(database, doctor_email, doctor_settings)
+                    save_settings_fields(database, doctor_email, {
+                        ("treatment_procedures",): firestore.ArrayUnion([new_procedure]),
+                        ("price_estimates", new_procedure): new_price
+                    })
                     st.success(f"New procedure '{new_procedure}' has been successfully added")
                     st.rerun()
                 else:
@@ -181,6 +205,9 @@ def show_chart(database, doctor_email, doctor_settings):
     health_conditions = doctor_settings.get("health_conditions", ["Healthy"])
     condition_colors = doctor_settings.get("condition_colors", {"Healthy": "#4CAF50"})
 
+    # Color edits made in the rows above are saved along with the next add or delete
+    edited_colors = {}
+
     st.subheader("Tooth Health Conditions")
     with st.container(border=True):
         if health_conditions:
@@ -202,7 +229,9 @@ def show_chart(database, doctor_email, doctor_settings):
                         value=current_color,
                         key=f"color_{i}"
                     )
-                    condition_colors[condition] = new_color
+                    if new_color != current_color:
+                        condition_colors[condition] = new_color
+                        edited_colors[("condition_colors", condition)] = new_color
 
                 with cols[2]:
                     if i > 0:  # Only show delete button for non-first conditions
@@ -211,12 +240,12 @@ def show_chart(database, doctor_email, doctor_settings):
                         st.write("")
                         if st.button("❌", key=f"delete_condition_{i}"):
                             health_conditions.pop(i)
-                            if condition in condition_colors:
-                                condition_colors.pop(condition)
 
-                            doctor_settings["health_conditions"] = health_conditions
-                            doctor_settings["condition_colors"] = condition_colors
-                            save_settings(database, doctor_email, doctor_settings)
+                            # Save the list (it carries any renames) and drop only this condition's color
+                            updates = dict(edited_colors)
+                            updates[("health_conditions",)] = health_conditions
+                            updates[("condition_colors", condition)] = firestore.DELETE_FIELD
+                            save_settings_fields(database, doctor_email, updates)
                             st.success("Health condition removed successfully")
                             st.rerun()
         else:
@@ -242,11 +271,11 @@ def show_chart(database, doctor_email, doctor_settings):
             if new_condition:
                 if new_condition.lower() not in [c.lower() for c in health_conditions]:
                     health_conditions.append(new_condition)
-                    condition_colors[new_condition] = new_color
 
-                    doctor_settings["health_conditions"] = health_conditions
-                    doctor_settings["condition_colors"] = condition_colors
-                    save_settings(database, doctor_email, doctor_settings)
+                    updates = dict(edited_colors)
+                    updates[("health_conditions",)] = health_conditions
+                    updates[("condition_colors", new_condition)] = new_color
+                    save_settings_fields(database, doctor_email, updates)
                     st.success(f"New health condition '{new_condition}' added successfully")
                     st.rerun()
                 else:
@@ -284,26 +313,21 @@ def show_currency(database, doctor_email, doctor_settings):
     st.info("Set your preferred currency for price estimates")
 
     current_currency = doctor_settings.get("currency", "SAR")
-    currency_options = {
-        "SAR": "Saudi Riyal (SAR)",
-        "INR": "Indian Rupee (₹)"
-    }
 
     # Display currency selection
     with st.container(border=True):
         selected_currency = st.selectbox(
             "Select Currency",
-            options=list(currency_options.keys()),
-            format_func=lambda x: currency_options[x],
-            index=list(currency_options.keys()).index(current_currency) if current_currency in currency_options else 0
+            options=CURRENCY_KEYS,
+            format_func=CURRENCY_OPTIONS.get,
+            index=CURRENCY_KEYS.index(current_currency) if current_currency in CURRENCY_OPTIONS else 0
         )
 
         # Save button for currency changes
         if st.button("✔️ Save Currency Preference", use_container_width=True):
             if selected_currency != current_currency:
-                doctor_settings["currency"] = selected_currency
-                save_settings(database, doctor_email, doctor_settings)
-                st.success(f"Currency updated to {currency_options[selected_currency]}")
+                save_settings_fields(database, doctor_email, {("currency",): selected_currency})
+                st.success(f"Currency updated to {CURRENCY_OPTIONS[selected_currency]}")
                 st.rerun()
 
 
@@ -340,11 +364,10 @@ def show_profile(database, doctor_email):
                             "hospital_name": new_hospital,
                             "hospital_address": new_address
                         })
+                        fetch_doctor.clear(doctor_email)
 
-                        # Update session state
+                        # Update session state (reports read the clinic details from the doctor profile)
                         st.session_state["doctor_name"] = new_name
-                        st.session_state["hospital_name"] = new_hospital
-                        st.session_state["hospital_address"] = new_address
                         st.success("Profile updated successfully!")
         else:
             st.error("Doctor profile not found. Please contact support.")
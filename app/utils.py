@@ -1,21 +1,174 @@
 import os
+import json
+import io
+import re
+import hashlib
 import cloudinary
 import requests
 import tempfile
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from fpdf import FPDF
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+from cloudinary.utils import cloudinary_url
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
+# Load environment variables from .env once per process (page scripts re-run, this module does not)
 load_dotenv()
 
+# (connect, read) timeout for outbound HTTP calls so a stalled endpoint can't hang the script run
+HTTP_TIMEOUT = (3, 5)
+
+# Image downloads for reports are larger, so they get a longer read timeout
+IMAGE_TIMEOUT = (3, 15)
+
+# Report-sized X-ray renditions are immutable per URL, so they are kept on local disk between reports
+XRAY_CACHE_DIR = os.path.join(tempfile.gettempdir(), "dentistfriend_xray")
+XRAY_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# Largest X-ray body a report will download; anything bigger is left out rather than held in memory to resize
+XRAY_MAX_DOWNLOAD_BYTES = 25 * 1024 * 1024
+
+# Report X-rays print 80 mm wide, which is ~945 px at 300 DPI; anything larger only bloats the PDF
+XRAY_REPORT_PX = 945
+
+# Settings used until a doctor saves their own configuration
+DEFAULT_SETTINGS = {
+    "treatment_procedures": ["Cleaning"],
+    "price_estimates": {"Cleaning": 100},
+    "health_conditions": ["Healthy"],
+    "condition_colors": {"Healthy": "#4CAF50"},
+    "currency": "SAR"
+}
+
+# Display symbol for each supported currency code
+CURRENCY_SYMBOLS = {
+    "SAR": "SAR",
+    "INR": "₹"
+}
+
+# Shared stylesheet, kept at module scope so it is built once per process
+CUSTOM_CSS = """
+<style>
+    .stButton > button {
+        padding: 12px 8px;
+        font-size: 16px;
+        font-weight: 500;
+        border-radius: 8px;
+        transition: all 0.3s ease;
+        box-shadow: 0 2px 5px rgba(0, 0, 0, 0.1);
+    }
+
+    .stButton > button:hover {
+        transform: translateY(-2px);
+        box-shadow: 0 4px 8px rgba(0, 0, 0, 0.15);
+    }
+
+    .stButton > button svg {
+        height: 20px;
+        width: 20px;
+        margin-right: 6px;
+    }
+
+    .stAlert {
+        border-radius: 8px;
+    }
+</style>
+"""
+
+
+@st.cache_resource
+def get_db():
+    """Initialize Firebase once per process and return the Firestore client shared by all sessions"""
+    # Imported lazily so pages that never touch Firestore don't pay for loading the gRPC stack
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    if not firebase_admin._apps:
+        cred = credentials.Certificate("firebase-config.json")
+        firebase_admin.initialize_app(cred)
+
+    return firestore.client()
+
+
+@st.cache_resource
+def get_http():
+    """Return a process-wide HTTP session so keep-alive and TLS resumption are reused across requests"""
+    session = requests.Session()
+
+    # Retry transient Google API and Cloudinary failures with a short backoff. POST stays out of the
+    # retried methods: the Identity Toolkit POSTs include sendOobCode, and replaying that after a 5xx
+    # could send the password-reset email twice
+    retry = Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        raise_on_status=False
+    )
+    # Report X-ray downloads run up to 8 at once against the same host, so keep room for them plus other callers
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+    return session
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_doctor(email):
+    """Fetch a doctor's profile document, cached briefly so repeated sign-in attempts skip Firestore"""
+    doctor_doc = get_db().collection("doctors").document(email).get()
+    return doctor_doc.to_dict() if doctor_doc.exists else None
+
+
+def run_parallel(*calls):
+    """Run independent (function, *args) calls on worker threads and return their results in order"""
+    # Workers inherit the script run context so caching and st.error keep working inside them
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=len(calls), initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        futures = [executor.submit(function, *args) for function, *args in calls]
+        return [future.result() for future in futures]
+
+
+@st.cache_resource
+def load_dental_data():
+    """Parse the static teeth map data once per process; callers must copy before changing it"""
+    with open("app/data.json", "r") as file:
+        return json.load(file)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_settings(doctor_email):
+    """Fetch a doctor's settings, or None if they haven't saved any yet; cleared whenever settings are saved"""
+    # Settings live on the doctor document, which sign-in has usually cached already
+    doctor_data = fetch_doctor(doctor_email) or {}
+    if "settings" in doctor_data:
+        return doctor_data["settings"]
+
+    # Older accounts keep them in a settings subcollection until sign-in copies them over (migrate_legacy_settings)
+    settings_doc = get_db().collection("doctors").document(doctor_email).collection("settings").document("config").get()
+    return settings_doc.to_dict() if settings_doc.exists else None
+
+
+def migrate_legacy_settings(doctor_email):
+    """Copy settings from the old settings subcollection onto the doctor document, if there are any to copy"""
+    doctor_reference = get_db().collection("doctors").document(doctor_email)
+    settings_doc = doctor_reference.collection("settings").document("config").get()
+    if settings_doc.exists:
+        doctor_reference.update({"settings": settings_doc.to_dict()})
+        fetch_doctor.clear(doctor_email)
+        fetch_settings.clear(doctor_email)
+
+
 def format_date(date_str):
     """Convert date string to formatted date (e.g., '2021-12-31' -> 'December 31, 2021')"""
     if isinstance(date_str, datetime):
         date_obj = date_str
     else:
         try:
-            date_obj = datetime.strptime(date_str, "%Y-%m-%d")
+            date_obj = datetime.fromisoformat(date_str)  # ISO dates skip strptime's format parsing
         except (ValueError, TypeError):
             return date_str  # Return original if parsing fails
 
@@ -39,8 +192,142 @@ def show_footer():
     )
 
 
-def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR", discount=0, vat=0, total_cost=0, xray_images=None):
-    """Generate a PDF document with treatment plan details and X-ray images"""
+def fetch_xray_images(xray_images):
+    """Return a local JPEG path for each X-ray (or None on failure) in input order, downloading cache misses concurrently"""
+    session = get_http()
+    os.makedirs(XRAY_CACHE_DIR, exist_ok=True)
+
+    def download(xray):
+        # Cloudinary scales and re-encodes on its side, so the PDF never pulls multi-MB originals
+        if xray.get("public_id"):
+            url, options = cloudinary_url(xray["public_id"], width=XRAY_REPORT_PX, crop="limit", quality="auto", format="jpg")
+        else:
+            url = cloudinary_variant(xray["url"])
+
+        # The rendition size is part of the key so resizing changes never serve stale full-size files
+        cache_key = hashlib.sha1(f"{url}@{XRAY_REPORT_PX}".encode()).hexdigest()
+        cache_path = os.path.join(XRAY_CACHE_DIR, cache_key + ".jpg")
+        if os.path.exists(cache_path):
+            # Touch on hit so eviction drops the least recently used images first
+            os.utime(cache_path)
+            return cache_path
+
+        temp_path = None
+        try:
+            # Stream the body so a download holds one chunk in memory rather than the whole image
+            with session.get(url, stream=True, timeout=IMAGE_TIMEOUT) as response:
+                if response.status_code != 200:
+                    return None
+
+                # When the size is announced, oversized images are dropped before any body is read
+                if int(response.headers.get("Content-Length") or 0) > XRAY_MAX_DOWNLOAD_BYTES:
+                    return None
+
+                # Chunked responses carry no Content-Length, so the cap is also enforced on the bytes actually read
+                received = 0
+
+                content = None
+                if url == xray.get("url"):
+                    # Not a Cloudinary delivery URL, so it comes back at full resolution - shrink it here instead
+                    body = bytearray()
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        body += chunk
+                        if len(body) > XRAY_MAX_DOWNLOAD_BYTES:
+                            return None
+                    content = downscale_xray(bytes(body))
+                    if content is None:
+                        return None
+
+                # Write to a private temp file then rename, so concurrent reports never read a partial image
+                file_handle, temp_path = tempfile.mkstemp(dir=XRAY_CACHE_DIR, suffix=".tmp")
+                with os.fdopen(file_handle, "wb") as temp_file:
+                    if content is not None:
+                        temp_file.write(content)
+                    else:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            received += len(chunk)
+                            if received > XRAY_MAX_DOWNLOAD_BYTES:
+                                return None  # The finally block removes the partial temp file
+                            temp_file.write(chunk)
+
+            os.replace(temp_path, cache_path)
+            temp_path = None
+            return cache_path
+        except (requests.RequestException, OSError):
+            return None
+        finally:
+            # A download that failed part-way must not leave its temp file behind in the cache directory
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    with ThreadPoolExecutor(max_workers=min(8, len(xray_images))) as executor:
+        image_paths = list(executor.map(download, xray_images))
+
+    prune_xray_cache()
+    return image_paths
+
+
+def cloudinary_variant(url):
+    """Rewrite a plain Cloudinary delivery URL to fetch the report-sized JPEG rendition"""
+    # Other hosts can use the same path layout but don't understand transformation segments
+    if urlparse(url).hostname != "res.cloudinary.com":
+        return url
+
+    # Only untransformed upload URLs are rewritten; anything else is returned as-is
+    variant = re.sub(r"/image/upload/(?![a-z]{1,2}_[^/]*/)",
+                     f"/image/upload/w_{XRAY_REPORT_PX},c_limit,q_auto/", url, count=1)
+    if variant == url:
+        return url
+
+    # The delivery extension picks the output format, and the PDF embeds X-rays as JPEG
+    return os.path.splitext(variant)[0] + ".jpg"
+
+
+def downscale_xray(content):
+    """Re-encode an image as a JPEG no larger than the report's printed footprint, or None if it can't be read"""
+    try:
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(content)))
+        if image.mode in ("I;16", "I;16B", "I;16L", "I"):
+            # 16/32-bit grayscale scans would be clipped by convert(); stretch their range into 8-bit first
+            image = image.convert("I")
+            low, high = image.getextrema()
+            scale = 255 / (high - low) if high > low else 0
+            image = image.point(lambda value: (value - low) * scale).convert("L")
+
+        image.thumbnail((XRAY_REPORT_PX, XRAY_REPORT_PX), Image.LANCZOS)
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85, optimize=True)
+        return buffer.getvalue()
+    except Exception:
+        return None  # Unreadable by Pillow; caching the raw bytes as .jpg would only give fpdf a file it can't parse
+
+
+def prune_xray_cache():
+    """Delete the least recently used cached X-rays once the cache grows past its size cap"""
+    try:
+        entries = [entry for entry in os.scandir(XRAY_CACHE_DIR) if entry.name.endswith(".jpg")]
+        total_size = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total_size <= XRAY_CACHE_MAX_BYTES:
+                break
+            total_size -= entry.stat().st_size
+            os.remove(entry.path)
+    except OSError:
+        # Another report may be pruning at the same time; the next call will catch up
+        pass
+
+
+def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR", discount=0, vat=0, total_cost=0, xray_images=None,
+                 hospital_name="", hospital_address=""):
+    """Generate a PDF document with treatment plan details and X-ray images and return its bytes"""
+    # Not cached as a whole: each report carries its own timestamp, and a failed image must be retried next time.
+    # Repeat reports are still cheap because the X-ray downloads come from the disk cache
 
     # Initialize PDF with margins
     pdf = FPDF(orientation="P", unit="mm", format="A4")
@@ -54,10 +341,6 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
 
     pdf.add_page()
 
-    # Get hospital information from session state
-    hospital_name = st.session_state.get("hospital_name", "")
-    hospital_address = st.session_state.get("hospital_address", "")
-
     # Hospital name and address at the top (if available)
     if hospital_name:
         pdf.set_font("Arial", "B", 16)
@@ -77,7 +360,9 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
 
     # Date on top right
     pdf.set_font("Arial", "", 10)
-    current_date = datetime.now().strftime("%B %d, %Y")
+    # One timestamp for the whole report, so the date, report ID and footer always agree
+    generated_at = datetime.now()
+    current_date = generated_at.strftime("%B %d, %Y")
     pdf.cell(0, 6, f"Date: {current_date}", 0, 1, "R")
 
     # Patient information section
@@ -90,9 +375,10 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
 
     # Patient and doctor details
     pdf.set_font("Arial", "", 11)
-    pdf.cell(0, 7, f"Dentist: {doctor_name}".title(), 0, 1)
-    pdf.cell(0, 7, f"Patient Name: {patient_name}".title(), 0, 1)
-    report_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    # Title-case only the names, not the labels around them
+    pdf.cell(0, 7, f"Dentist: {doctor_name.title()}", 0, 1)
+    pdf.cell(0, 7, f"Patient Name: {patient_name.title()}", 0, 1)
+    report_id = generated_at.strftime('%Y%m%d%H%M%S')
     pdf.cell(0, 7, f"Report ID: {report_id}", 0, 1)
     pdf.ln(5)
 
@@ -142,34 +428,38 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
             pdf.cell(available_widths[i], 10, col, 1, 0, "C", True)
         pdf.ln()
 
+        # Characters that fit on one line of each column, used to estimate row heights
+        max_chars_per_line = {
+            "Tooth": 10,
+            "Condition": int(condition_width / 2),  # Approx 2mm per char
+            "Procedure": int(procedure_width / 2),
+            "Cost": 15
+        }
+
+        # Per-column layout is the same for every row, so work it out once: (name, width, align, chars per line, wraps)
+        col_specs = [
+            (col, width, "R" if col == "Cost" else "L", max_chars_per_line.get(col, 20), col in ("Condition", "Procedure"))
+            for col, width in zip(available_columns, available_widths)
+        ]
+
         # Add treatment data rows with alternating colors
         pdf.set_font("Arial", "", 10)
         for idx, item in enumerate(treatment_plan):
-            # Check if we need to alternate row colors
+            # Odd rows get a light gray background
             if idx % 2 == 1:
                 pdf.set_fill_color(245, 245, 245)
-                fill = True
             else:
-                fill = False
-
-            # Calculate needed heights for each cell based on content
-            max_chars_per_line = {
-                "Tooth": 10,
-                "Condition": int(condition_width / 2),  # Approx 2mm per char
-                "Procedure": int(procedure_width / 2),
-                "Cost": 15
-            }
+                pdf.set_fill_color(255, 255, 255)
 
             cell_heights = {}
             cell_texts = {}
 
             # First pass: calculate row height
-            for col in available_columns:
+            for col, width, align, chars_per_line, wraps in col_specs:
                 value = str(item.get(col, ""))
                 cell_texts[col] = value
 
-                if len(value) > max_chars_per_line.get(col, 20) and col in ["Condition", "Procedure"]:
-                    chars_per_line = max_chars_per_line.get(col, 20)
+                if wraps and len(value) > chars_per_line:
                     # Estimate number of lines needed
                     num_lines = len(value) / chars_per_line
                     cell_heights[col] = max(8, int(num_lines * 6))  # 6mm per line, minimum 8mm
@@ -185,17 +475,15 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
 
             # Draw all cell backgrounds and borders first
             current_x = start_x
-            for i, col in enumerate(available_columns):
-                width = available_widths[i]
+            for col, width, align, chars_per_line, wraps in col_specs:
                 # Draw cell background and border only
-                pdf.set_fill_color(245, 245, 245) if fill else pdf.set_fill_color(255, 255, 255)
                 pdf.rect(current_x, start_y, width, row_height, style="DF")
                 current_x += width
 
             # Second pass: add content to cells
+            pdf.set_draw_color(0, 0, 0)
             current_x = start_x
-            for i, col in enumerate(available_columns):
-                width = available_widths[i]
+            for col, width, align, chars_per_line, wraps in col_specs:
                 value = cell_texts[col]
 
                 # Format currency for cost column
@@ -205,11 +493,8 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
                     except ValueError:
                         pass
 
-                # Set alignment based on column type
-                align = "R" if col == "Cost" else "L"
-
                 # Handle text differently based on length and column
-                if len(value) > max_chars_per_line.get(col, 20) and col in ["Condition", "Procedure"]:
+                if wraps and len(value) > chars_per_line:
                     pdf.set_xy(current_x + 1, start_y + 1)  # Add 1mm padding
 
                     # Use multi_cell with border=0 to avoid extra lines
@@ -228,7 +513,6 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
                     pdf.cell(width - 2, 4, value, 0, 0, align, 0)
 
                 # Draw border lines manually to ensure clean borders
-                pdf.set_draw_color(0, 0, 0)
                 pdf.line(current_x, start_y, current_x, start_y + row_height)  # Left
                 pdf.line(current_x + width, start_y, current_x + width, start_y + row_height)  # Right
                 pdf.line(current_x, start_y, current_x + width, start_y)  # Top
@@ -247,12 +531,14 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
     pdf.line(15, pdf.get_y(), 195, pdf.get_y())
     pdf.ln(5)
 
-    # Calculate final cost
-    final_cost = total_cost
+    # Calculate final cost in integer cents, the same way the cost summary tab does, so the
+    # report's total can never drift a cent away from the one shown on screen
+    final_cents = round(total_cost * 100)
     if isinstance(discount, (int, float)):
-        final_cost -= discount
+        final_cents -= round(discount * 100)
     if isinstance(vat, (int, float)):
-        final_cost += vat
+        final_cents += round(vat * 100)
+    final_cost = final_cents / 100
 
     # Define column layout for cost table
     col1_width = 120
@@ -264,23 +550,23 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
 
     # Total row
     pdf.cell(col1_width, 8, "Total Treatment Cost", 1, 0, "L", True)
-    pdf.cell(col2_width, 8, f"{display_currency} {float(total_cost):.2f}", 1, 1, "R", True)
+    pdf.cell(col2_width, 8, f"{display_currency} {total_cost:.2f}", 1, 1, "R", True)
 
     # Discount row (if applicable)
     if discount > 0:
         pdf.cell(col1_width, 8, "Discount", 1, 0, "L")
-        pdf.cell(col2_width, 8, f"-{display_currency} {float(discount):.2f}", 1, 1, "R")
+        pdf.cell(col2_width, 8, f"-{display_currency} {discount:.2f}", 1, 1, "R")
 
     # VAT row (if applicable)
     if vat > 0:
         pdf.cell(col1_width, 8, "VAT (15%)", 1, 0, "L")
-        pdf.cell(col2_width, 8, f"+{display_currency} {float(vat):.2f}", 1, 1, "R")
+        pdf.cell(col2_width, 8, f"+{display_currency} {vat:.2f}", 1, 1, "R")
 
     # Final total row with highlighting
     pdf.set_font("Arial", "B", 10)
     pdf.set_fill_color(230, 230, 230)  # Darker highlight for total
     pdf.cell(col1_width, 8, "Final Total", 1, 0, "L", True)
-    pdf.cell(col2_width, 8, f"{display_currency} {float(final_cost):.2f}", 1, 1, "R", True)
+    pdf.cell(col2_width, 8, f"{display_currency} {final_cost:.2f}", 1, 1, "R", True)
 
     if xray_images and len(xray_images) > 0:
         # Add a new page for X-rays if there's not enough space
@@ -303,7 +589,10 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
         current_x = 15
         current_y = pdf.get_y()
 
-        for i, xray in enumerate(xray_images):
+        # Fetch every image up front in parallel (from the disk cache when possible) rather than one request per loop iteration
+        image_paths = fetch_xray_images(xray_images)
+
+        for i, (xray, image_path) in enumerate(zip(xray_images, image_paths)):
             # Check if we need to move to next row or new page
             if i > 0 and i % images_per_row == 0:
                 current_x = 15
@@ -315,30 +604,20 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
                     current_y = 15 + 10  # Top margin + padding
 
             try:
-                # Create a temporary file for the image
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-                    temp_img_path = temp_file.name
-
-                # Download image from Cloudinary URL
-                response = requests.get(xray["url"], stream=True)
-                if response.status_code == 200:
-                    with open(temp_img_path, 'wb') as f:
-                        f.write(response.content)
-
-                    # Add image to PDF with balanced dimensions
-                    pdf.image(temp_img_path, x=current_x, y=current_y, w=max_image_width)
-
-                    # Add caption under the image
-                    caption_y = current_y + max_image_height - 10
-                    pdf.set_xy(current_x, caption_y)
-                    pdf.set_font("Arial", "", 8)
-                    pdf.multi_cell(max_image_width, 5, xray.get("caption", "X-Ray Image"), 0, 'C')
-
-                    # Clean up temporary file
-                    os.remove(temp_img_path)
-
-                    # Move x position for next image
-                    current_x += max_image_width + 15  # Image width + padding
+                if image_path is None:
+                    raise ValueError("X-ray download failed")
+
+                # Add image to PDF with balanced dimensions, straight from the cached file
+                pdf.image(image_path, x=current_x, y=current_y, w=max_image_width)
+
+                # Add caption under the image
+                caption_y = current_y + max_image_height - 10
+                pdf.set_xy(current_x, caption_y)
+                pdf.set_font("Arial", "", 8)
+                pdf.multi_cell(max_image_width, 5, xray.get("caption", "X-Ray Image"), 0, 'C')
+
+                # Move x position for next image
+                current_x += max_image_width + 15  # Image width + padding
             except Exception as e:
                 pdf.set_font("Arial", "", 10)
                 pdf.set_xy(current_x, current_y)
@@ -348,14 +627,20 @@ def generate_pdf(doctor_name, patient_name, treatment_plan, currency_symbol="SAR
     # Add footer with proper spacing
     pdf.ln(15)
     pdf.set_font("Arial", "I", 8)
-    generation_time = datetime.now()
     pdf.cell(0, 5, "Generated by Dental Treatment Planner", 0, 1, "C")
-    pdf.cell(0, 5, f"This report was generated on {generation_time.strftime('%B %d, %Y')} at {generation_time.strftime('%H:%M')}.", 0, 1, "C")
+    pdf.cell(0, 5, f"This report was generated on {current_date} at {generated_at.strftime('%H:%M')}.", 0, 1, "C")
+
+    # Render in memory; fpdf returns a latin-1 string for dest="S"
+    return pdf.output(dest="S").encode("latin-1")
 
-    # Generate filename and output PDF
-    filename = f"{patient_name.replace(' ', '_')}_treatment_plan.pdf"
-    pdf.output(filename)
-    return filename
+
+# Colored box drawn above each tooth's selector; only the color and number change per tooth
+TOOTH_BOX_HTML = ('<div style="background-color: {color}; color: white; text-align: center; padding: 10px 0; '
+                  'border-radius: 5px; font-weight: bold;">{number}</div>')
+
+# One grid per chart row, with the same gap as st.columns so each box sits above its selector
+TOOTH_ROW_HTML = ('<div style="display: grid; grid-template-columns: repeat({count}, 1fr); gap: 1rem; '
+                  'margin-bottom: 5px;">{boxes}</div>')
 
 
 def render_chart(dental_data, dental_chart=None, doctor_settings=None):
@@ -363,65 +648,46 @@ def render_chart(dental_data, dental_chart=None, doctor_settings=None):
     if dental_chart is None:
         dental_chart = {}
 
+    # Selections go into a copy so the session's patient record only changes once the chart is actually saved
+    updated_chart = dict(dental_chart)
+
     # Get patient type from session state (default to adult if not specified)
     patient_type = st.session_state.patient_selected.get("patient_type", "adult").lower()
 
-    # Use appropriate teeth map and rows based on patient type
+    # Use appropriate teeth rows based on patient type; the static layout is only read, never copied
     if patient_type == "child" and "child" in dental_data:
-        teeth_map = dental_data["child"]["teeth_map"].copy()
         teeth_rows = dental_data["child"]["teeth_rows"]
     else:
         # Default to adult dental chart
-        teeth_map = dental_data["adult"]["teeth_map"].copy()
         teeth_rows = dental_data["adult"]["teeth_rows"]
 
-    # Merge existing dental chart data with teeth map
-    for tooth in teeth_map:
-        if tooth in dental_chart:
-            teeth_map[tooth] = dental_chart[tooth]
-
     # Get health conditions and colors from doctor settings
     health_conditions = doctor_settings.get("health_conditions", ["Healthy"])
     condition_colors = doctor_settings.get("condition_colors", {"Healthy": "#4CAF50"})
 
-    # Track if chart has been modified
-    chart_changed = False
+    # Only a selector the user actually changed counts as an edit; update_tooth flags it before this run
+    chart_changed = st.session_state.pop("chart_edited", False)
 
     st.header("Dental Chart Assessment")
     with st.container(border=True):
         # Process each row of teeth in the dental chart
         for teeth_row in teeth_rows:
+            # Get current condition from the session state first (for immediate updates)
+            # or fall back to dental_chart, or default to "Healthy"
+            row_conditions = [st.session_state.get(f"tooth_condition_{tooth_number}", dental_chart.get(tooth_number, "Healthy"))
+                              for tooth_number in teeth_row]
+
+            # Draw the whole row of colored boxes as one grid, so a row costs one frontend element instead of one per tooth
+            # (gray when the condition has no color configured)
+            row_boxes = "".join(TOOTH_BOX_HTML.format(color=condition_colors.get(condition, "#808080"), number=tooth_number)
+                                for tooth_number, condition in zip(teeth_row, row_conditions))
+            st.markdown(TOOTH_ROW_HTML.format(count=len(teeth_row), boxes=row_boxes), unsafe_allow_html=True)
+
             # Create appropriate number of columns based on row length
             cols = st.columns(len(teeth_row))
 
-            for i, tooth_number in enumerate(teeth_row):
+            for i, (tooth_number, current_condition) in enumerate(zip(teeth_row, row_conditions)):
                 with cols[i]:
-                    # Get current condition from the session state first (for immediate updates)
-                    # or fall back to dental_chart, or default to "Healthy"
-                    current_condition = st.session_state.get(f"tooth_condition_{tooth_number}",
-                                                          dental_chart.get(tooth_number, "Healthy"))
-
-                    # Get the appropriate color for this tooth's condition
-                    tooth_color = condition_colors.get(current_condition, "#808080")  # Default to gray if not found
-
-                    # Create a visual box for the tooth with the appropriate color
-                    st.markdown(
-                        f"""
-                        <div style="
-                            background-color: {tooth_color};
-                            color: white;
-                            text-align: center;
-                            padding: 10px 0;
-                            border-radius: 5px;
-                            font-weight: bold;
-                            margin-bottom: 5px;
-                        ">
-                            {tooth_number}
-                        </div>
-                        """,
-                        unsafe_allow_html=True
-                    )
-
                     # Dropdown selector for tooth condition
                     default_index = 0
                     try:
@@ -439,38 +705,35 @@ def render_chart(dental_data, dental_chart=None, doctor_settings=None):
                         args=(tooth_number,)
                     )
 
-                    # Store selected condition in session state for immediate visual updates
-                    st.session_state[f"tooth_condition_{tooth_number}"] = selected_condition
-
-                    # Track changes to dental chart
-                    if tooth_number not in dental_chart or dental_chart[tooth_number] != selected_condition:
-                        dental_chart[tooth_number] = selected_condition
-                        chart_changed = True
+                    # Store selected condition in session state for immediate visual updates; update_tooth already
+                    # did this for a changed selector, so the write only happens when the stored value is stale
+                    if selected_condition != current_condition:
+                        st.session_state[f"tooth_condition_{tooth_number}"] = selected_condition
 
-                        # Auto-select unhealthy teeth for potential treatment
-                        if selected_condition != "Healthy":
-                            st.session_state.tooth_selected = tooth_number
+                    updated_chart[tooth_number] = selected_condition
 
-    return dental_chart, chart_changed
+    return updated_chart, chart_changed
 
 
 def update_tooth(tooth_number):
     """Update tooth condition in session state."""
     selected_value = st.session_state[f"tooth_{tooth_number}"]
     st.session_state[f"tooth_condition_{tooth_number}"] = selected_value
+    st.session_state.chart_edited = True
+
+    # Auto-select unhealthy teeth for potential treatment
+    if selected_value != "Healthy":
+        st.session_state.tooth_selected = tooth_number
 
 
 def get_currency_symbol(currency_code):
     """Return the appropriate currency symbol based on currency code."""
-    currency_symbols = {
-        "SAR": "SAR",
-        "INR": "₹"
-    }
-    return currency_symbols.get(currency_code, currency_code)
+    return CURRENCY_SYMBOLS.get(currency_code, currency_code)
 
 
+@st.cache_resource
 def configure_cloudinary():
-    """Configure Cloudinary using environment variables"""
+    """Configure Cloudinary from environment variables once per process; later calls are no-ops"""
     cloudinary.config(
         cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
         api_key=os.getenv('CLOUDINARY_API_KEY'),
@@ -480,30 +743,5 @@ def configure_cloudinary():
 
 
 def custom_css():
-    st.markdown("""
-        <style>
-            .stButton > button {
-                padding: 12px 8px;
-                font-size: 16px;
-                font-weight: 500;
-                border-radius: 8px;
-                transition: all 0.3s ease;
-                box-shadow: 0 2px 5px rgba(0, 0, 0, 0.1);
-            }
-
-            .stButton > button:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 4px 8px rgba(0, 0, 0, 0.15);
-            }
-
-            .stButton > button svg {
-                height: 20px;
-                width: 20px;
-                margin-right: 6px;
-            }
-
-            .stAlert {
-                border-radius: 8px;
-            }
-        </style>
-    """, unsafe_allow_html=True)
+    """Inject the shared button and alert styles into the current page"""
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)